@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# Shared HTTP client for the API tools in this repository (cloudflare_update_record, gitlab_runner_cleanup,
+# trello_archive_cleanup): pooled keep-alive session with connect/read timeouts, retries with jittered exponential
+# backoff honoring 429/Retry-After, bounded concurrency and per-endpoint request metrics, logged at the end of a run
+# and optionally written as Prometheus textfile for node_exporter's textfile collector.
+#
+# The tools import it from this folder:
+#   sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'api_client'))
+#   import api_client
+
+import email.utils
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+import requests
+
+
+retryable_status_codes = [429, 500, 502, 503, 504]
+# upper bounds of the request duration histogram in seconds
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+# path segments looking like IDs are replaced in endpoint names, so metrics are per endpoint instead of per object
+id_segment_pattern = re.compile(r'^(\d+|[0-9a-fA-F]{16,}|[0-9a-fA-F]{8}-[0-9a-fA-F-]{27})$')
+# API versions at the start of the path are kept, e.g. the "1" of Trello's api.trello.com/1/
+version_segment_pattern = re.compile(r'^v?\d{1,2}$')
+# values of query parameters in logged URLs and error messages, they can carry credentials
+query_value_pattern = re.compile(r'([?&][^=&#\s]+=)[^&#\s\'")]*')
+
+
+def add_arguments(parser):
+    ''' Add timeout and metrics arguments shared by all tools using the client '''
+    parser.add_argument('-to', '--timeout', help='Read timeout of API requests in seconds', type=float, default=30.0)
+    parser.add_argument('-cto', '--connect-timeout', help='Connect timeout of API requests in seconds', type=float, default=5.0)
+    parser.add_argument('-mf', '--metrics-file', help='Write request metrics as Prometheus textfile to this path, e.g. for node_exporter')
+
+
+def get_backoff(attempt, base=1.0, cap=60.0):
+    ''' Exponential backoff with jitter, half fixed and half random, so parallel workers don't retry in lockstep '''
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def parse_retry_after(value):
+    ''' Retry-After as seconds, it can be given as seconds or HTTP date, None if missing or unparsable '''
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def redact(text):
+    ''' Text with the values of query parameters in URLs replaced, for logging '''
+    return query_value_pattern.sub(r'\1***', str(text))
+
+
+def get_endpoint(method, url):
+    ''' Endpoint name for metrics, e.g. "GET api.trello.com/1/boards/:id/cards/closed" '''
+    parts = urlsplit(url)
+    segments = parts.path.split('/')
+    path = '/'.join(':id' if id_segment_pattern.match(segment) and not (position == 1 and version_segment_pattern.match(segment)) else segment
+                    for position, segment in enumerate(segments))
+    return f'{method.upper()} {parts.netloc}{path}'
+
+
+class RateLimiter:
+    ''' Sliding window limiter shared by all worker threads '''
+    def __init__(self, max_requests, window):
+        self.max_requests = max_requests
+        self.window = window
+        self.timestamps = deque()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.timestamps and now - self.timestamps[0] >= self.window:
+                    self.timestamps.popleft()
+                if len(self.timestamps) < self.max_requests:
+                    self.timestamps.append(now)
+                    return
+                delay = self.window - (now - self.timestamps[0])
+            time.sleep(delay)
+
+
+class Metrics:
+    ''' Request count, status codes and latency per endpoint, thread-safe '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = defaultdict(lambda: {'statuses': Counter(), 'latencies': [], 'retries': 0})
+
+    def record(self, method, url, status, seconds):
+        ''' Record a finished request, status is "error" for requests without response '''
+        with self.lock:
+            endpoint = self.endpoints[get_endpoint(method, url)]
+            endpoint['statuses'][str(status)] += 1
+            endpoint['latencies'].append(seconds)
+
+    def record_retry(self, method, url):
+        with self.lock:
+            self.endpoints[get_endpoint(method, url)]['retries'] += 1
+
+    def log_summary(self):
+        with self.lock:
+            for name, endpoint in sorted(self.endpoints.items()):
+                latencies = sorted(endpoint['latencies'])
+                count = len(latencies)
+                percentiles = ', '.join(f'p{percent} {latencies[max(-(-percent * count // 100) - 1, 0)] * 1000:.0f}ms' for percent in (50, 95, 99))
+                logging.info(f"{name}: {count} requests, {endpoint['retries']} retries, statuses {dict(endpoint['statuses'])}, {percentiles}, max {latencies[-1] * 1000:.0f}ms")
+
+    def write_textfile(self, path, job):
+        ''' Write metrics in Prometheus text format, atomically as the textfile collector expects '''
+        lines = [
+            '# HELP api_client_requests_total API requests by endpoint and status code, "error" if there was no response.',
+            '# TYPE api_client_requests_total counter',
+        ]
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            for name, endpoint in endpoints:
+                method, endpoint_path = name.split(' ', 1)
+                for status, count in sorted(endpoint['statuses'].items()):
+                    lines.append(f'api_client_requests_total{{job="{job}",method="{method}",endpoint="{endpoint_path}",status="{status}"}} {count}')
+            lines += [
+                '# HELP api_client_retries_total Retried API requests by endpoint.',
+                '# TYPE api_client_retries_total counter',
+            ]
+            for name, endpoint in endpoints:
+                method, endpoint_path = name.split(' ', 1)
+                lines.append(f'api_client_retries_total{{job="{job}",method="{method}",endpoint="{endpoint_path}"}} {endpoint["retries"]}')
+            lines += [
+                '# HELP api_client_request_duration_seconds API request duration by endpoint.',
+                '# TYPE api_client_request_duration_seconds histogram',
+            ]
+            for name, endpoint in endpoints:
+                method, endpoint_path = name.split(' ', 1)
+                labels = f'job="{job}",method="{method}",endpoint="{endpoint_path}"'
+                for bucket in latency_buckets:
+                    lines.append(f'api_client_request_duration_seconds_bucket{{{labels},le="{bucket}"}} {sum(1 for latency in endpoint["latencies"] if latency <= bucket)}')
+                lines.append(f'api_client_request_duration_seconds_bucket{{{labels},le="+Inf"}} {len(endpoint["latencies"])}')
+                lines.append(f'api_client_request_duration_seconds_sum{{{labels}}} {sum(endpoint["latencies"]):.6f}')
+                lines.append(f'api_client_request_duration_seconds_count{{{labels}}} {len(endpoint["latencies"])}')
+        lines += [
+            '# HELP api_client_last_run_timestamp_seconds End of the last run of the job.',
+            '# TYPE api_client_last_run_timestamp_seconds gauge',
+            f'api_client_last_run_timestamp_seconds{{job="{job}"}} {time.time():.0f}',
+        ]
+        with open(f'{path}.tmp', 'w', encoding='UTF-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f'{path}.tmp', path)
+
+
+class ApiClient:
+    ''' Pooled requests session with timeouts, retries and metrics. The session records metrics of all responses
+    through a hook, so libraries it is handed to (e.g. python-gitlab) show up in the metrics as well. '''
+    def __init__(self, base_url='', headers=None, params=None, timeout=30.0, connect_timeout=5.0, retries=5, pool_size=10, rate_limiter=None):
+        self.base_url = base_url.rstrip('/')
+        self.params = params or {}
+        self.timeout = (connect_timeout, timeout)
+        self.retries = retries
+        self.rate_limiter = rate_limiter
+        self.metrics = Metrics()
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.hooks['response'].append(self.record_response)
+
+    def record_response(self, response, *args, **kwargs):
+        # elapsed is the time until the response headers were parsed
+        self.metrics.record(response.request.method, response.request.url, response.status_code, response.elapsed.total_seconds())
+
+    def request(self, method, path, params=None, **kwargs):
+        ''' Make request to path below base URL or to an absolute URL, retrying on connection errors, timeouts, 429
+        (honoring Retry-After) and server errors. Returns the last response, raises requests.RequestException if
+        the last attempt got no response at all. '''
+        url = path if re.match(r'https?://', path) else f"{self.base_url}/{path.lstrip('/')}"
+        params = dict(self.params, **(params or {}))
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.wait()
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, params=params, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.metrics.record(method, url, 'error', time.monotonic() - start)
+                if attempt == self.retries:
+                    raise
+                delay = get_backoff(attempt)
+                logging.warning(f"{method} request to '{redact(path)}' failed: {redact(e)}, retrying in {delay:.1f}s...")
+            else:
+                if response.status_code not in retryable_status_codes:
+                    return response
+                if attempt == self.retries:
+                    logging.error(f"{method} request to '{redact(path)}' failed with status {response.status_code} after {self.retries} retries: {response.text}")
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                delay = retry_after if retry_after is not None else get_backoff(attempt)
+                logging.warning(f"{method} request to '{redact(path)}' failed with status {response.status_code}, retrying in {delay:.1f}s...")
+            self.metrics.record_retry(method, url)
+            time.sleep(delay)
+
+    def report(self, args, job):
+        ''' Log metrics summary and write Prometheus textfile if --metrics-file was given '''
+        self.metrics.log_summary()
+        if getattr(args, 'metrics_file', None):
+            try:
+                self.metrics.write_textfile(args.metrics_file, job)
+            except OSError as e:
+                logging.error(f"Could not write metrics to '{args.metrics_file}': {e}")
+
+
+class BoundedExecutor:
+    ''' Thread pool whose submit blocks while max_pending tasks are queued or running, so producers like paginated
+    listings only run as far ahead as the workers. Slots are released even if a callback raises. '''
+    def __init__(self, workers, max_pending=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending or workers * 2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(wait=True)
+
+    def submit(self, fn, *args, callback=None):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda done: self.on_done(done, callback))
+        return future
+
+    def on_done(self, future, callback):
+        try:
+            if callback:
+                callback(future)
+        except Exception:
+            logging.exception('Callback of a bounded task failed')
+        finally:
+            self.slots.release()
+
+    def map(self, fn, items):
+        ''' Like ThreadPoolExecutor.map, results in order of items '''
+        return self.executor.map(fn, items)
@@ -0,0 +1,596 @@
+#!/usr/bin/env python3
+
+# Streaming variant of backup_ts_to_cloud.sh: DB dump and podman volume export are streamed through tar,
+# multi-threaded compression and encryption straight into `rclone rcat`, without any temporary copies on disk.
+#
+# Archive layout: the DB dump as consecutive parts ts_db_backup_<date>.sql.part0000, ... and the files of the podman
+# volume below ts_volume_export_<date>/. Tar members need their size upfront, so the dump is split into parts of fixed
+# size instead of being buffered as a whole and the volume export is re-emitted member by member instead of as nested tar.
+# Restore: decrypt and decompress, then `tar -xOf <archive> --wildcards 'ts_db_backup_*' > dump.sql` and extract
+# the volume files, `tar -C ts_volume_export_<date> -c . | podman volume import teamspeak -`
+#
+# With --dedup the same tar stream is split into content-defined chunks instead, only chunks that are not on the remote yet
+# get compressed, encrypted and uploaded to <folder>/chunks/ and a manifest listing the chunks of the day is written to
+# <folder>/snapshots/. --restore <date|latest> reassembles the tar stream from a manifest, --keep-snapshots prunes old
+# manifests and chunks no remaining manifest references. Chunk names are keyed with a secret chunk key, which is stored
+# encrypted to the same recipient in <folder>/keys/, so a restore only needs the private key.
+
+import argparse
+import collections
+import datetime
+import hmac
+import io
+import json
+import logging
+import lzma
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+log_levels = {'crit': logging.CRITICAL, 'warn': logging.WARN, 'info': logging.INFO, 'debug': logging.DEBUG}
+compressors = {
+    'xz': (['xz', '-T0', '-c'], 'xz'),
+    'zstd': (['zstd', '-T0', '-c', '-q'], 'zst'),
+}
+encryptors = {
+    'gpg': (lambda public_key: ['gpg', '--batch', '--yes', '--trust-model', 'always', '--recipient-file', public_key, '--encrypt'], 'gpg'),
+    'age': (lambda public_key: ['age', '-R', public_key], 'age'),
+}
+decryptors = {
+    'gpg': lambda identity: ['gpg', '--batch', '--quiet', '--decrypt'],
+    'age': lambda identity: ['age', '-d', '-i', identity],
+}
+# size of the DB dump parts, one part is held in memory at a time since tar needs the member size before the data
+DUMP_PART_SIZE = 32 * 1024 * 1024
+# FastCDC style chunking: a gear rolling hash is updated at every byte and a chunk is cut where its top bits are 0,
+# with a stricter mask below CHUNK_AVG_SIZE and a looser one above to keep chunk sizes close to the average.
+# The hash only depends on the last GEAR_WINDOW bytes, so cut points survive insertions and deletions earlier in the stream.
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVG_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_MASK_SMALL = ((1 << 22) - 1) << 42
+CHUNK_MASK_LARGE = ((1 << 18) - 1) << 46
+GEAR_WINDOW = 64
+GEAR_HASH_MASK = (1 << 64) - 1
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', '--public-key', help='Public key file to encrypt the backup with')
+    parser.add_argument('-c', '--mariadb-container', help='Name of the MariaDB container to dump the database from')
+    parser.add_argument('-r', '--rclone-remote', help='rclone remote to upload to, e.g. "gdrive" or ":local:"', required=True)
+    parser.add_argument('-f', '--remote-folder', help='Folder on the rclone remote', default='ts_backups')
+    parser.add_argument('-d', '--database', help='Database to dump', default='teamspeak')
+    parser.add_argument('-vo', '--volume', help='Podman volume to export', default='teamspeak')
+    parser.add_argument('-z', '--compression', help=f'Compression, possible choices: {list(compressors)}', choices=list(compressors), default='xz')
+    parser.add_argument('-e', '--encryption', help=f'Encryption tool, possible choices: {list(encryptors)}', choices=list(encryptors), default='gpg')
+    parser.add_argument('-rt', '--retention', help='Remove backups older than this from the remote folder (rclone --min-age format), empty to keep all', default='5d')
+    parser.add_argument('-dd', '--dedup', help='Upload only new content-defined chunks and a snapshot manifest instead of a full archive, chunks are always xz compressed', action='store_true')
+    parser.add_argument('-ks', '--keep-snapshots', help='Number of snapshots to keep in dedup mode, chunks only referenced by older ones are removed, 0 to keep all', type=int, default=5)
+    parser.add_argument('-ci', '--chunk-index', help='Local index of chunks on the remote in dedup mode', default='backup_ts_chunk_index.json')
+    parser.add_argument('-ck', '--chunk-key', help='Secret key file for chunk names and boundaries in dedup mode, created on the first backup and uploaded encrypted to <folder>/keys/, restores without it fetch it from there', default='backup_ts_chunk_key')
+    parser.add_argument('-ri', '--rebuild-index', help='Rebuild the local chunk index from a listing of the remote before backing up', action='store_true')
+    parser.add_argument('-w', '--workers', help='Parallel chunk uploads and downloads in dedup mode', type=int, default=4)
+    parser.add_argument('-R', '--restore', help='Restore snapshot of this date (YYYY_MM_DD) or "latest" from dedup mode as tar to --output')
+    parser.add_argument('-o', '--output', help='Output file for --restore, "-" for stdout', default='-')
+    parser.add_argument('-i', '--identity', help='Private key file to decrypt with for --restore, only needed for age, gpg uses its keyring')
+    parser.add_argument('-v', '--log-level', help=f'Log level, possible choices: {list(log_levels)}', default='info')
+    args = parser.parse_args()
+    if not args.restore and not (args.public_key and args.mariadb_container):
+        parser.error('the following arguments are required for backups: -k/--public-key, -c/--mariadb-container')
+    return args
+
+
+def setup_logging(args):
+    ''' Set log level '''
+    if args.log_level not in log_levels:
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=log_levels['info'])
+        logging.warning(f'Specified log level "{args.log_level}" is not allowed, see output of -h for possible values')
+    else:
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=log_levels[args.log_level])
+        logging.debug(f'Set log level "{args.log_level}"')
+
+
+def get_dump_command(args):
+    return ['podman', 'exec', args.mariadb_container, 'sh', '-c', f'exec mariadb-dump {args.database} -uroot -p"$MARIADB_ROOT_PASSWORD"']
+
+
+def get_volume_export_command(args):
+    return ['podman', 'volume', 'export', args.volume]
+
+
+def check_process(process, name):
+    if process.wait() != 0:
+        raise RuntimeError(f'{name} exited with code {process.returncode}')
+
+
+def start_upload_pipeline(remote_path, args):
+    ''' Start compressor | encryptor | rclone rcat, returns processes, write the archive into the stdin of the first one '''
+    compress_command = compressors[args.compression][0]
+    encrypt_command = encryptors[args.encryption][0]
+    compressor = subprocess.Popen(compress_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    encryptor = subprocess.Popen(encrypt_command(args.public_key), stdin=compressor.stdout, stdout=subprocess.PIPE)
+    uploader = subprocess.Popen(['rclone', 'rcat', remote_path], stdin=encryptor.stdout)
+    # only the next process in the chain may hold the read ends, otherwise EOF never propagates
+    compressor.stdout.close()
+    encryptor.stdout.close()
+    return [(compressor, args.compression), (encryptor, args.encryption), (uploader, 'rclone rcat')]
+
+
+def stop_processes(processes):
+    ''' Terminate and reap processes still running, e.g. after a failure, so no dump or encryption is left behind '''
+    for process, name in processes:
+        if process.poll() is None:
+            logging.warning(f'Stopping {name}...')
+            process.terminate()
+    for process, name in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def add_db_dump(archive, name, processes, args):
+    ''' Stream dump into archive as consecutive parts <name>.part0000, ... of DUMP_PART_SIZE bytes '''
+    logging.info('Dumping TS database...')
+    dump = subprocess.Popen(get_dump_command(args), stdout=subprocess.PIPE)
+    processes.append((dump, 'mariadb-dump'))
+    size = 0
+    part_number = 0
+    while True:
+        data = dump.stdout.read(DUMP_PART_SIZE)
+        # an empty dump still gets one empty part
+        if not data and part_number:
+            break
+        member = tarfile.TarInfo(f'{name}.part{part_number:04d}')
+        member.size = len(data)
+        member.mtime = time.time()
+        member.mode = 0o600
+        archive.addfile(member, io.BytesIO(data))
+        size += len(data)
+        part_number += 1
+        if len(data) < DUMP_PART_SIZE:
+            break
+    check_process(dump, 'mariadb-dump')
+    logging.info(f'Added database dump with {size} bytes in {part_number} parts')
+
+
+def add_volume_export(archive, prefix, processes, args):
+    logging.info('Exporting TS podman volume...')
+    export = subprocess.Popen(get_volume_export_command(args), stdout=subprocess.PIPE)
+    processes.append((export, 'podman volume export'))
+    member_count = 0
+    with tarfile.open(fileobj=export.stdout, mode='r|') as volume:
+        for member in volume:
+            name = member.name.removeprefix('./').rstrip('/')
+            member.name = prefix if name in ('', '.') else f'{prefix}/{name}'
+            archive.addfile(member, volume.extractfile(member) if member.isreg() else None)
+            member_count += 1
+    check_process(export, 'podman volume export')
+    logging.info(f'Added {member_count} entries from volume "{args.volume}"')
+
+
+def run_command(command, name, data=None):
+    result = subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f'{name} exited with code {result.returncode}: {result.stderr.decode(errors="replace").strip()}')
+    return result.stdout
+
+
+def remove_old_backups(remote_folder, args):
+    logging.info('Removing old backup archives in cloud...')
+    # only archives at the top level, dedup mode keeps chunks/ and snapshots/ in the same folder
+    subprocess.run(['rclone', 'delete', '--min-age', args.retention, '--max-depth', '1', '--include', 'ts_backup_*', f'{remote_folder}/'], check=True)
+
+
+def backup_archive(remote_folder, today, args):
+    archive_name = f'ts_backup_{today}.tar.{compressors[args.compression][1]}.{encryptors[args.encryption][1]}'
+    logging.info(f'Streaming backup to "{remote_folder}/{archive_name}"...')
+    start = time.monotonic()
+    processes = start_upload_pipeline(f'{remote_folder}/{archive_name}', args)
+    compressor = processes[0][0]
+    # dump and export processes are added by the steps starting them
+    pipeline = list(processes)
+    try:
+        with tarfile.open(fileobj=compressor.stdin, mode='w|') as archive:
+            add_db_dump(archive, f'ts_db_backup_{today}.sql', processes, args)
+            add_volume_export(archive, f'ts_volume_export_{today}', processes, args)
+        compressor.stdin.close()
+        for process, name in pipeline:
+            check_process(process, name)
+    except (RuntimeError, OSError, tarfile.TarError) as e:
+        logging.critical(f'Backup failed: {e}')
+        sys.exit(1)
+    finally:
+        stop_processes(processes)
+    logging.info(f'Backup uploaded in {time.monotonic() - start:.1f}s')
+
+    if args.retention:
+        remove_old_backups(remote_folder, args)
+
+
+def gear_hash(data, value, gear):
+    for byte in data:
+        value = ((value << 1) + gear[byte]) & GEAR_HASH_MASK
+    return value
+
+
+def gear_find(data, value, mask, gear):
+    ''' Roll gear hash over data, returns offset after the first byte where the masked hash is 0 (-1 if none) and the hash '''
+    for offset, byte in enumerate(data):
+        value = ((value << 1) + gear[byte]) & GEAR_HASH_MASK
+        if not value & mask:
+            return offset + 1, value
+    return -1, value
+
+
+def get_gear_table(key):
+    ''' Derive the gear table from the chunk key, so chunk sizes reveal nothing about the content without it '''
+    return [int.from_bytes(hmac.new(key, b'gear' + bytes([byte]), 'sha256').digest()[:8], 'big') for byte in range(256)]
+
+
+class ChunkWriter:
+    ''' Write-only file object for tarfile, splits the stream into content-defined chunks and passes them to on_chunk '''
+    def __init__(self, on_chunk, gear):
+        self.on_chunk = on_chunk
+        self.gear = gear
+        self.buffer = bytearray()
+        self.reset()
+
+    def reset(self):
+        # bytes before scan_pos are rolled into hash, the first cut point candidate is at CHUNK_MIN_SIZE
+        self.scan_pos = CHUNK_MIN_SIZE - GEAR_WINDOW
+        self.hash = 0
+
+    def write(self, data):
+        self.buffer += data
+        while (cut := self.find_cut()):
+            self.emit(cut)
+        return len(data)
+
+    def find_cut(self):
+        ''' Roll hash over the data not scanned yet, returns the chunk size at the next cut point or None if more data is needed '''
+        # scan_pos starts GEAR_WINDOW bytes before CHUNK_MIN_SIZE and must never move back below that
+        if len(self.buffer) <= self.scan_pos:
+            return None
+        if self.scan_pos < CHUNK_MIN_SIZE:
+            end = min(len(self.buffer), CHUNK_MIN_SIZE)
+            self.hash = gear_hash(self.buffer[self.scan_pos:end], self.hash, self.gear)
+            self.scan_pos = end
+        for limit, mask in ((CHUNK_AVG_SIZE, CHUNK_MASK_SMALL), (CHUNK_MAX_SIZE, CHUNK_MASK_LARGE)):
+            end = min(len(self.buffer), limit)
+            if CHUNK_MIN_SIZE <= self.scan_pos < end:
+                offset, self.hash = gear_find(self.buffer[self.scan_pos:end], self.hash, mask, self.gear)
+                if offset != -1:
+                    return self.scan_pos + offset
+                self.scan_pos = end
+        if self.scan_pos >= CHUNK_MAX_SIZE:
+            return CHUNK_MAX_SIZE
+        return None
+
+    def emit(self, cut):
+        chunk = bytes(self.buffer[:cut])
+        del self.buffer[:cut]
+        self.reset()
+        self.on_chunk(chunk)
+
+    def flush(self):
+        if self.buffer:
+            self.emit(len(self.buffer))
+
+
+def get_chunk_path(remote_folder, chunk_id):
+    return f'{remote_folder}/chunks/{chunk_id[:2]}/{chunk_id}'
+
+
+def get_snapshot_path(remote_folder, date):
+    return f'{remote_folder}/snapshots/ts_backup_{date}.json'
+
+
+def list_snapshots(remote_folder):
+    ''' Get dates of snapshots on the remote, oldest first '''
+    names = run_command(['rclone', 'lsf', '--files-only', f'{remote_folder}/snapshots'], 'rclone lsf').decode().split()
+    return sorted(name[len('ts_backup_'):-len('.json')] for name in names if name.startswith('ts_backup_') and name.endswith('.json'))
+
+
+def get_manifest(remote_folder, date):
+    return json.loads(run_command(['rclone', 'cat', get_snapshot_path(remote_folder, date)], 'rclone cat'))
+
+
+def upload_chunk(chunk, chunk_id, remote_folder, args):
+    encrypted = run_command(encryptors[args.encryption][0](args.public_key), args.encryption, lzma.compress(chunk))
+    run_command(['rclone', 'rcat', get_chunk_path(remote_folder, chunk_id)], 'rclone rcat', encrypted)
+    return len(encrypted)
+
+
+def get_key_id(key):
+    return hmac.new(key, b'chunk key id', 'sha256').hexdigest()[:16]
+
+
+def get_key_path(remote_folder, key_id, encryption):
+    return f'{remote_folder}/keys/{key_id}.{encryptors[encryption][1]}'
+
+
+def upload_chunk_key(remote_folder, key, args):
+    ''' Upload chunk key encrypted to the backup recipient unless it is there already, restores on other hosts need it '''
+    key_path = get_key_path(remote_folder, get_key_id(key), args.encryption)
+    try:
+        names = run_command(['rclone', 'lsf', '--files-only', f'{remote_folder}/keys'], 'rclone lsf').decode().split()
+    except RuntimeError:
+        names = []
+    if key_path.rsplit('/', 1)[1] in names:
+        return
+    logging.info(f'Uploading encrypted chunk key to "{key_path}"...')
+    encrypted = run_command(encryptors[args.encryption][0](args.public_key), args.encryption, key)
+    run_command(['rclone', 'rcat', key_path], 'rclone rcat', encrypted)
+
+
+def get_restore_key(remote_folder, manifest, args):
+    ''' Chunk key of a snapshot, the local one if it matches, downloaded from the remote and decrypted otherwise '''
+    key_id = manifest['chunk_key']
+    try:
+        key = load_chunk_key(args)
+        if get_key_id(key) == key_id:
+            return key
+        logging.info(f'Local chunk key "{args.chunk_key}" is not the one of the snapshot')
+    except FileNotFoundError:
+        logging.info(f'No local chunk key at "{args.chunk_key}"')
+    key_path = get_key_path(remote_folder, key_id, manifest['encryption'])
+    logging.info(f'Downloading chunk key from "{key_path}"...')
+    key = run_command(decryptors[manifest['encryption']](args.identity), manifest['encryption'], run_command(['rclone', 'cat', key_path], 'rclone cat'))
+    if get_key_id(key) != key_id:
+        raise RuntimeError(f'Chunk key at "{key_path}" does not match the snapshot')
+    return key
+
+
+def get_chunk_id(chunk, key):
+    # keyed, a plain hash of the content would let anyone with access to the remote confirm guessed content
+    return hmac.new(key, chunk, 'sha256').hexdigest()
+
+
+def download_chunk(chunk_id, remote_folder, encryption, key, args):
+    encrypted = run_command(['rclone', 'cat', get_chunk_path(remote_folder, chunk_id)], 'rclone cat')
+    chunk = lzma.decompress(run_command(decryptors[encryption](args.identity), encryption, encrypted))
+    if not hmac.compare_digest(get_chunk_id(chunk, key), chunk_id):
+        raise RuntimeError(f'Chunk {chunk_id} is corrupt')
+    return chunk
+
+
+def load_chunk_key(args, create=False):
+    ''' Read secret key for chunk names and boundaries, create it if missing and requested '''
+    try:
+        with open(args.chunk_key, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        if not create:
+            raise
+    logging.warning(f'Creating chunk key "{args.chunk_key}"')
+    key = os.urandom(32)
+    with open(os.open(f'{args.chunk_key}.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+        f.write(key)
+    os.replace(f'{args.chunk_key}.tmp', args.chunk_key)
+    return key
+
+
+def load_chunk_index(remote_folder, args):
+    ''' Load local index of chunks on the remote, rebuild it from a remote listing if missing, for another remote or requested '''
+    index = None
+    if not args.rebuild_index:
+        try:
+            with open(args.chunk_index, 'r', encoding='UTF-8') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            logging.info(f'No chunk index at "{args.chunk_index}" yet')
+        except ValueError:
+            logging.warning(f'Chunk index at "{args.chunk_index}" is corrupt, rebuilding it')
+    if index is not None and index.get('remote') == remote_folder:
+        return index
+    logging.info(f'Building chunk index from listing of "{remote_folder}/chunks"...')
+    index = {'remote': remote_folder, 'chunks': {}, 'snapshots': {}}
+    try:
+        listing = json.loads(run_command(['rclone', 'lsjson', '-R', '--files-only', f'{remote_folder}/chunks'], 'rclone lsjson'))
+    except RuntimeError as e:
+        logging.warning(f'Listing chunks failed, starting with empty index: {e}')
+        listing = []
+    for entry in listing:
+        index['chunks'][entry['Name']] = {'size': None, 'stored_size': entry['Size']}
+    return index
+
+
+def save_chunk_index(index, args):
+    with open(f'{args.chunk_index}.tmp', 'w', encoding='UTF-8') as f:
+        json.dump(index, f)
+    os.replace(f'{args.chunk_index}.tmp', args.chunk_index)
+
+
+class ChunkStore:
+    ''' Uploads chunks that are neither in the index nor in flight, blocks the writer if too many uploads are pending '''
+    def __init__(self, remote_folder, index, key, args):
+        self.remote_folder = remote_folder
+        self.index = index
+        self.key = key
+        self.args = args
+        self.executor = ThreadPoolExecutor(max_workers=args.workers)
+        self.slots = threading.BoundedSemaphore(args.workers * 2)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.failed = []
+        self.chunk_ids = []
+        self.stats = collections.Counter()
+
+    def add(self, chunk):
+        chunk_id = get_chunk_id(chunk, self.key)
+        self.chunk_ids.append(chunk_id)
+        self.stats['size'] += len(chunk)
+        with self.lock:
+            if chunk_id in self.index['chunks'] or chunk_id in self.pending:
+                self.stats['reused'] += 1
+                return
+            self.pending.add(chunk_id)
+        self.slots.acquire()
+        future = self.executor.submit(upload_chunk, chunk, chunk_id, self.remote_folder, self.args)
+        future.add_done_callback(lambda done: self.on_done(done, chunk_id, len(chunk)))
+
+    def on_done(self, future, chunk_id, size):
+        try:
+            stored_size = future.result()
+            with self.lock:
+                self.index['chunks'][chunk_id] = {'size': size, 'stored_size': stored_size}
+                self.stats['uploaded'] += 1
+                self.stats['uploaded_bytes'] += stored_size
+        except (RuntimeError, OSError) as e:
+            logging.error(f'Uploading chunk {chunk_id} failed: {e}')
+            with self.lock:
+                self.failed.append(chunk_id)
+        finally:
+            with self.lock:
+                self.pending.discard(chunk_id)
+            self.slots.release()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def prune_snapshots(remote_folder, index, args):
+    ''' Remove all but the newest snapshots and the chunks only they referenced '''
+    dates = list_snapshots(remote_folder)
+    if len(dates) <= args.keep_snapshots:
+        return
+    expired, kept = dates[:-args.keep_snapshots], dates[-args.keep_snapshots:]
+    referenced = set()
+    for date in kept:
+        if date not in index['snapshots']:
+            index['snapshots'][date] = get_manifest(remote_folder, date)['chunks']
+        referenced.update(index['snapshots'][date])
+    # manifests go first, so an interrupted prune never leaves a snapshot with missing chunks
+    for date in expired:
+        logging.info(f'Removing snapshot {date}...')
+        run_command(['rclone', 'deletefile', get_snapshot_path(remote_folder, date)], 'rclone deletefile')
+        index['snapshots'].pop(date, None)
+    unreferenced = [chunk_id for chunk_id in index['chunks'] if chunk_id not in referenced]
+    if unreferenced:
+        logging.info(f'Removing {len(unreferenced)} unreferenced chunks...')
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as files_from:
+            files_from.write(''.join(f'{chunk_id[:2]}/{chunk_id}\n' for chunk_id in unreferenced))
+            files_from.flush()
+            run_command(['rclone', 'delete', '--files-from-raw', files_from.name, f'{remote_folder}/chunks'], 'rclone delete')
+        for chunk_id in unreferenced:
+            del index['chunks'][chunk_id]
+
+
+def backup_dedup(remote_folder, today, args):
+    try:
+        key = load_chunk_key(args, create=True)
+        upload_chunk_key(remote_folder, key, args)
+    except (RuntimeError, OSError) as e:
+        logging.critical(f'Loading or uploading chunk key failed: {e}')
+        sys.exit(1)
+    index = load_chunk_index(remote_folder, args)
+    logging.info(f'Backing up new chunks to "{remote_folder}", {len(index["chunks"])} chunks already there...')
+    start = time.monotonic()
+    store = ChunkStore(remote_folder, index, key, args)
+    writer = ChunkWriter(store.add, get_gear_table(key))
+    processes = []
+    try:
+        # no dates in member names, every changed tar header would change its chunk
+        with tarfile.open(fileobj=writer, mode='w|') as archive:
+            add_db_dump(archive, 'ts_db_backup.sql', processes, args)
+            add_volume_export(archive, 'ts_volume_export', processes, args)
+        writer.flush()
+    except (RuntimeError, OSError, tarfile.TarError) as e:
+        logging.critical(f'Backup failed: {e}')
+        store.failed.append(None)
+    finally:
+        stop_processes(processes)
+    store.close()
+    # keep uploaded chunks in the index even if the snapshot failed, the next run reuses them
+    save_chunk_index(index, args)
+    if store.failed:
+        logging.critical('Not writing snapshot manifest because of failed chunks')
+        sys.exit(1)
+
+    manifest = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'size': store.stats['size'],
+        'compression': 'xz',
+        'encryption': args.encryption,
+        'chunk_key': get_key_id(key),
+        'chunks': store.chunk_ids,
+    }
+    try:
+        run_command(['rclone', 'rcat', get_snapshot_path(remote_folder, today)], 'rclone rcat', json.dumps(manifest).encode())
+    except RuntimeError as e:
+        logging.critical(f'Writing snapshot manifest failed: {e}')
+        sys.exit(1)
+    index['snapshots'][today] = store.chunk_ids
+    logging.info(f'Snapshot {today} with {len(store.chunk_ids)} chunks ({store.stats["size"]} bytes) written in {time.monotonic() - start:.1f}s, '
+                 f'uploaded {store.stats["uploaded"]} new chunks ({store.stats["uploaded_bytes"]} bytes), reused {store.stats["reused"]}')
+
+    if args.keep_snapshots > 0:
+        try:
+            prune_snapshots(remote_folder, index, args)
+        except RuntimeError as e:
+            logging.error(f'Pruning snapshots failed: {e}')
+    save_chunk_index(index, args)
+
+
+def restore_snapshot(remote_folder, args):
+    ''' Download, decrypt and reassemble the tar stream of a snapshot in order, keeping a bounded window of chunks in flight '''
+    try:
+        date = list_snapshots(remote_folder)[-1] if args.restore == 'latest' else args.restore
+        manifest = get_manifest(remote_folder, date)
+    except (RuntimeError, IndexError, ValueError) as e:
+        logging.critical(f'Loading snapshot manifest "{args.restore}" failed: {e}')
+        sys.exit(1)
+    if manifest['encryption'] == 'age' and not args.identity:
+        logging.critical('Snapshot is encrypted with age, -i/--identity is required')
+        sys.exit(1)
+    try:
+        key = get_restore_key(remote_folder, manifest, args)
+    except (RuntimeError, OSError) as e:
+        logging.critical(f'Loading chunk key failed, it is needed to verify the chunks: {e}')
+        sys.exit(1)
+    logging.info(f'Restoring snapshot {date} with {len(manifest["chunks"])} chunks ({manifest["size"]} bytes) to "{args.output}"...')
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    window = collections.deque()
+    try:
+        for chunk_id in manifest['chunks']:
+            window.append(executor.submit(download_chunk, chunk_id, remote_folder, manifest['encryption'], key, args))
+            if len(window) >= args.workers * 2:
+                output.write(window.popleft().result())
+        while window:
+            output.write(window.popleft().result())
+    except (RuntimeError, OSError, lzma.LZMAError) as e:
+        logging.critical(f'Restore failed: {e}')
+        executor.shutdown(cancel_futures=True)
+        sys.exit(1)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+    executor.shutdown()
+    logging.info('Restore done')
+
+
+def main():
+    args = setup_parser()
+    setup_logging(args)
+    today = datetime.date.today().strftime('%Y_%m_%d')
+    remote_folder = f'{args.rclone_remote.rstrip(":")}:{args.remote_folder}'
+    if args.restore:
+        restore_snapshot(remote_folder, args)
+    elif args.dedup:
+        backup_dedup(remote_folder, today, args)
+    else:
+        backup_archive(remote_folder, today, args)
+
+
+if __name__ == '__main__':
+    main()
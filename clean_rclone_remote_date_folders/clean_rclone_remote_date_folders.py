@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Python variant of clean_rclone_remote_date_folders.sh: lists the remote folder once, parses the dates from the
+# folder names and purges expired folders concurrently. Besides a maximum age, the newest folder of each of the last
+# n days, weeks and months can be kept.
+
+import argparse
+import datetime
+import json
+import logging
+import re
+import subprocess
+import sys
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+log_levels = {'crit': logging.CRITICAL, 'warn': logging.WARN, 'info': logging.INFO, 'debug': logging.DEBUG}
+# YYYY-MM-DD, YYYY_MM_DD, YYYY.MM.DD or YYYYMMDD anywhere in the folder name, e.g. "ts_backup_2024_01_31"
+folder_date_pattern = re.compile(r'(?<!\d)(\d{4})[-_.]?(\d{2})[-_.]?(\d{2})(?!\d)')
+retention_periods = {
+    'daily': lambda date: date,
+    'weekly': lambda date: date.isocalendar()[:2],
+    'monthly': lambda date: (date.year, date.month),
+}
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--remote', help='rclone remote name, e.g. "gdrive" or ":local:"', required=True)
+    parser.add_argument('-s', '--subfolder', help='Folder on the remote containing the date folders', default='')
+    parser.add_argument('-ma', '--max-age-days', help='Keep all folders younger than this many days', type=int, default=7)
+    parser.add_argument('-kd', '--keep-daily', help='Also keep the newest folder of each of the last n days with folders', type=int, default=0)
+    parser.add_argument('-kw', '--keep-weekly', help='Also keep the newest folder of each of the last n weeks with folders', type=int, default=0)
+    parser.add_argument('-km', '--keep-monthly', help='Also keep the newest folder of each of the last n months with folders', type=int, default=0)
+    parser.add_argument('-w', '--workers', help='Number of concurrent rclone purge processes', type=int, default=4)
+    parser.add_argument('-nc', '--no-cleanup', help="Don't run rclone cleanup on the remote after purging", action='store_true')
+    parser.add_argument('-f', '--no-dry-run', help='Deactivate dry run and actually purge folders.', action='store_true')
+    parser.add_argument('-v', '--log-level', help=f'Log level, possible choices: {list(log_levels)}', default='info')
+    args = parser.parse_args()
+    return args
+
+
+def setup_logging(args):
+    ''' Set log level '''
+    if args.log_level not in log_levels:
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=log_levels['info'])
+        logging.warning(f'Specified log level "{args.log_level}" is not allowed, see output of -h for possible values')
+    else:
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=log_levels[args.log_level])
+        logging.debug(f'Set log level "{args.log_level}"')
+
+
+def get_remote_path(args, folder=None):
+    # same form as the shell script, remote:/subfolder, the leading slash matters for remotes like sftp
+    path = f'{args.remote.rstrip(":")}:/{args.subfolder.rstrip("/")}'
+    if folder:
+        path = f'{path.rstrip("/")}/{folder}'
+    return path
+
+
+def parse_folder_date(name):
+    match = folder_date_pattern.search(name)
+    if not match:
+        return None
+    try:
+        return datetime.date(*(int(part) for part in match.groups()))
+    except ValueError:
+        return None
+
+
+def get_date_folders(args):
+    ''' List folders of the remote path with a single rclone call, returns folders with parsed dates, newest first '''
+    result = subprocess.run(['rclone', 'lsjson', '--dirs-only', get_remote_path(args)], capture_output=True, text=True)
+    if result.returncode != 0:
+        logging.critical(f'Listing "{get_remote_path(args)}" failed: {result.stderr.strip()}')
+        sys.exit(1)
+    folders = []
+    for entry in json.loads(result.stdout):
+        date = parse_folder_date(entry['Name'])
+        if date is None:
+            logging.debug(f'Skipping folder "{entry["Name"]}" without date in its name')
+            continue
+        folders.append({'name': entry['Name'], 'date': date})
+    # same date: the name sorting last counts as newest, e.g. one with a later time suffix
+    folders.sort(key=lambda folder: (folder['date'], folder['name']), reverse=True)
+    return folders
+
+
+def get_keep_reasons(folders, today, args):
+    ''' Map names of folders to keep to the retention rules keeping them, folders must be sorted newest first '''
+    keep = {}
+    oldest_kept = today - datetime.timedelta(days=args.max_age_days)
+    for folder in folders:
+        if folder['date'] > oldest_kept:
+            keep.setdefault(folder['name'], []).append('max age')
+    for period, count in (('daily', args.keep_daily), ('weekly', args.keep_weekly), ('monthly', args.keep_monthly)):
+        seen = set()
+        for folder in folders:
+            key = retention_periods[period](folder['date'])
+            if key in seen:
+                continue
+            if len(seen) >= count:
+                break
+            seen.add(key)
+            keep.setdefault(folder['name'], []).append(period)
+    return keep
+
+
+def purge_folder(folder, args):
+    result = subprocess.run(['rclone', 'purge', get_remote_path(args, folder['name'])], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+    return folder
+
+
+def purge_folders(folders, args):
+    ''' Purge folders with a bounded number of concurrent rclone processes, returns number of failed purges '''
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(purge_folder, folder, args): folder for folder in folders}
+        for future in as_completed(futures):
+            try:
+                logging.info(f'Purged "{future.result()["name"]}"')
+            except RuntimeError as e:
+                failed += 1
+                logging.error(f'Purging "{futures[future]["name"]}" failed: {e}')
+    return failed
+
+
+def main():
+    args = setup_parser()
+    setup_logging(args)
+    today = datetime.date.today()
+    folders = get_date_folders(args)
+    keep = get_keep_reasons(folders, today, args)
+    expired = [folder for folder in folders if folder['name'] not in keep]
+
+    for folder in folders:
+        if folder['name'] in keep:
+            logging.info(f'keep   {folder["name"]} ({", ".join(keep[folder["name"]])})')
+        else:
+            logging.info(f'purge  {folder["name"]} ({(today - folder["date"]).days} days old)')
+    logging.info(f'{len(folders)} date folders in "{get_remote_path(args)}", keeping {len(keep)}, purging {len(expired)}')
+
+    if not args.no_dry_run:
+        logging.info('Dry run, not purging anything. Use -f to actually purge folders.')
+        return
+    failed = purge_folders(expired, args)
+    if not args.no_cleanup:
+        result = subprocess.run(['rclone', 'cleanup', f'{args.remote.rstrip(":")}:'], capture_output=True, text=True)
+        if result.returncode != 0:
+            logging.warning(f'rclone cleanup failed, the remote might not support it: {result.stderr.strip()}')
+    if failed:
+        logging.critical(f'Purging {failed} of {len(expired)} folders failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,15 @@
 
 import argparse
 import logging
+import os
 import re
-import requests
 import sys
 import yaml
 
+# shared HTTP client from ../api_client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'api_client'))
+import api_client
+
 
 log_levels = {'crit': logging.CRITICAL, 'warn': logging.WARN, 'info': logging.INFO, 'debug': logging.DEBUG}
 required_config_keys = ['read_token', 'edit_token', 'zone_name', 'record_name']
@@ -24,8 +28,11 @@ def setup_parser():
     parser.add_argument('-f', '--force', help='Force setting IP address, if it is set already', action='store_true')
     parser.add_argument('-4p', '--ipv4-provider', help='Provider for IPv4 address', default='https://ipv4.icanhazip.com')
     parser.add_argument('-6p', '--ipv6-provider', help='Provider for IPv6 address', default='https://ipv6.icanhazip.com')
+    parser.add_argument('-a', '--api-url', help='Cloudflare API base URL', default='https://api.cloudflare.com/client/v4')
     parser.add_argument('-v', '--log-level', help=f'Log level, possible choices: {list(log_levels)}', default='info')
     parser.add_argument('-l', '--log-file', help='Log file', default='cloudflare_update_record.log')
+    parser.add_argument('-r', '--retries', help='Retries per request on connection errors, 429 or server errors', type=int, default=3)
+    api_client.add_arguments(parser)
     args = parser.parse_args()
     return args
 
@@ -63,11 +70,14 @@ def get_ip(version, args):
         return False
 
 
+def setup_client(args):
+    # one pooled client per run, zone lookup, record lookup and update reuse the connection to the API
+    global client
+    client = api_client.ApiClient(timeout=args.timeout, connect_timeout=args.connect_timeout, retries=args.retries, pool_size=2)
+
+
 def make_request(kind, url, headers=None, data=None, exit_on_fail=False):
-    if kind == 'get':
-        response = requests.get(url, headers=headers, data=data)
-    elif kind == 'put':
-        response = requests.put(url, headers=headers, data=data)
+    response = client.request(kind.upper(), url, headers=headers, data=data)
 
     if response.status_code == 200:
         return True, response
@@ -109,14 +119,14 @@ def get_config(config_file):
         logging.critical(f'Could not find config file at {config_file} - exiting...')
         sys.exit(1)
 
-def get_identifiers(config, record_type):
-    request_successful, zone_id_response = make_request('get', f'https://api.cloudflare.com/client/v4/zones?name={config["zone_name"]}', headers={"Authorization": f"Bearer {config['read_token']}", "Content-Type": "application/json"}, exit_on_fail=True)
+def get_identifiers(config, record_type, args):
+    request_successful, zone_id_response = make_request('get', f'{args.api_url}/zones?name={config["zone_name"]}', headers={"Authorization": f"Bearer {config['read_token']}", "Content-Type": "application/json"}, exit_on_fail=True)
     zone_identifier = zone_id_response.json()['result'][0]['id']
 
     if config["record_name"] == "@":
-        request_successful, record_id_response = make_request('get', f'https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records?name={config["zone_name"]}&type={record_type}', headers={"Authorization": f"Bearer {config['read_token']}", "Content-Type": "application/json"}, exit_on_fail=True)
+        request_successful, record_id_response = make_request('get', f'{args.api_url}/zones/{zone_identifier}/dns_records?name={config["zone_name"]}&type={record_type}', headers={"Authorization": f"Bearer {config['read_token']}", "Content-Type": "application/json"}, exit_on_fail=True)
     else:
-        request_successful, record_id_response = make_request('get', f'https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records?name={config["record_name"]}.{config["zone_name"]}&type={record_type}', headers={"Authorization": f"Bearer {config['read_token']}", "Content-Type": "application/json"}, exit_on_fail=True)
+        request_successful, record_id_response = make_request('get', f'{args.api_url}/zones/{zone_identifier}/dns_records?name={config["record_name"]}.{config["zone_name"]}&type={record_type}', headers={"Authorization": f"Bearer {config['read_token']}", "Content-Type": "application/json"}, exit_on_fail=True)
 
     try:
         record_identifier = record_id_response.json()['result'][0]['id']
@@ -127,8 +137,8 @@ def get_identifiers(config, record_type):
     return zone_identifier, record_identifier, record_ip
 
 
-def update_record(config, ip, record_type, zone_identifier, record_identifier):
-    request_successful, response = make_request('put', f'https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records/{record_identifier}', headers={"Authorization": f"Bearer {config['edit_token']}", "Content-Type": "application/json"}, data=f'{{"id": "{zone_identifier}", "type": "{record_type}", "name": "{config["record_name"]}","content": "{ip}"}}')
+def update_record(config, ip, record_type, zone_identifier, record_identifier, args):
+    request_successful, response = make_request('put', f'{args.api_url}/zones/{zone_identifier}/dns_records/{record_identifier}', headers={"Authorization": f"Bearer {config['edit_token']}", "Content-Type": "application/json"}, data=f'{{"id": "{zone_identifier}", "type": "{record_type}", "name": "{config["record_name"]}","content": "{ip}"}}')
 
     if request_successful:
         logging.info(f'DNS {record_type} record update succeeded, IP changed to: "{ip}"')
@@ -153,13 +163,13 @@ def main(ip_version, record_type, args):
         if ip_different:
             config = get_config(args.config)
             check_config(config, args.config)
-            zone_identifier, record_identifier, record_ip = get_identifiers(config, record_type)
+            zone_identifier, record_identifier, record_ip = get_identifiers(config, record_type, args)
             if current_ip_address != record_ip:
-                update_record(config, current_ip_address, record_type, zone_identifier, record_identifier)
+                update_record(config, current_ip_address, record_type, zone_identifier, record_identifier, args)
                 write_ip(current_ip_address, ip_version)
             elif current_ip_address == record_ip and args.force:
                 logging.warning(f'Force parameter is set. Setting IP address "{current_ip_address}" even though it is equal to IP of DNS record "{config["record_name"]}" in zone "{config["zone_name"]}" already.')
-                update_record(config, current_ip_address, record_type, zone_identifier, record_identifier)
+                update_record(config, current_ip_address, record_type, zone_identifier, record_identifier, args)
                 write_ip(current_ip_address, ip_version)
             else:
                 logging.info(f'Current IPv{ip_version} address "{current_ip_address}" is equal to IP of DNS record "{config["record_name"]}" in zone "{config["zone_name"]}" already: "{record_ip}". Exiting...')
@@ -173,7 +183,11 @@ if __name__ == '__main__':
     if not args.ipv4 and not args.ipv6:
         logging.critical('Neither -4 nor -6 parameter is set - exiting...')
         sys.exit(1)
-    if args.ipv4:
-        main(4, 'A', args)
-    if args.ipv6:
-        main(6, 'AAAA', args)
+    setup_client(args)
+    try:
+        if args.ipv4:
+            main(4, 'A', args)
+        if args.ipv6:
+            main(6, 'AAAA', args)
+    finally:
+        client.report(args, 'cloudflare_update_record')
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Benchmark cloudflare_update_record.py against the in-process fake Cloudflare API from fake_cloudflare_api.py.
+# Reports API requests per record update and wall time for single- and many-record setups.
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import yaml
+
+import cloudflare_update_record
+from fake_cloudflare_api import FakeCloudflare, FakeCloudflareServer
+
+
+ZONE_NAME = 'example.com'
+OLD_IP = '198.51.100.1'
+NEW_IP = '192.0.2.1'
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--records', help='Number of records for the many-record run', type=int, default=50)
+    parser.add_argument('-r', '--rounds', help='Rounds per scenario, timings are averaged', type=int, default=3)
+    parser.add_argument('-lt', '--latency', help='Simulated latency per fake API request in seconds', type=float, default=0.0)
+    parser.add_argument('-rl', '--rate-limit-every', help='Answer every n-th API request with 429, 0 to disable', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+
+def get_update_args(server, config_file, local_cache):
+    ''' Build the argument namespace cloudflare_update_record.main() expects '''
+    return argparse.Namespace(config=config_file, ipv4=True, ipv6=False, local_cache=local_cache, force=False,
+                              ipv4_provider=f'{server.base_url}/ipv4', ipv6_provider=f'{server.base_url}/ipv6',
+                              api_url=server.api_url, log_level='crit', log_file=os.devnull,
+                              retries=3, timeout=30.0, connect_timeout=5.0, metrics_file=None)
+
+
+def write_configs(cloudflare, record_count, work_dir):
+    configs = []
+    for i in range(record_count):
+        record_name = f'host{i}'
+        cloudflare.add_record(ZONE_NAME, f'{record_name}.{ZONE_NAME}', 'A', OLD_IP)
+        config_file = os.path.join(work_dir, f'config_{record_name}.yaml')
+        with open(config_file, 'w', encoding='UTF-8') as f:
+            yaml.safe_dump({'read_token': cloudflare.read_token, 'edit_token': cloudflare.edit_token, 'zone_name': ZONE_NAME, 'record_name': record_name}, f)
+        configs.append(config_file)
+    return configs
+
+
+def set_record_ips(cloudflare, ip):
+    for records in cloudflare.records.values():
+        for record in records.values():
+            record['content'] = ip
+
+
+def run_scenario(server, configs, local_cache):
+    ''' Run one update per config, return wall time, request counter and number of failed updates '''
+    server.cloudflare.reset_stats()
+    failed = 0
+    start = time.perf_counter()
+    for config_file in configs:
+        update_args = get_update_args(server, config_file, local_cache)
+        # every cron run is a new process with a new client
+        cloudflare_update_record.setup_client(update_args)
+        try:
+            cloudflare_update_record.main(4, 'A', update_args)
+        except SystemExit:
+            failed += 1
+    duration = time.perf_counter() - start
+    return duration, server.cloudflare.requests.copy(), failed
+
+
+def benchmark(server, configs, label, rounds):
+    ''' Run the changed IP, unchanged IP and local cache hit scenarios for the given configs '''
+    cloudflare = server.cloudflare
+    scenarios = [
+        ('IP changed', OLD_IP, False, False),
+        ('IP unchanged', NEW_IP, False, False),
+        ('local cache hit', NEW_IP, True, True),
+    ]
+    results = []
+    for name, record_ip, local_cache, cache_file in scenarios:
+        durations = []
+        for _ in range(rounds):
+            set_record_ips(cloudflare, record_ip)
+            if cache_file:
+                cloudflare_update_record.write_ip(NEW_IP, 4)
+            elif os.path.exists('cloudflare_update_record_ip4.txt'):
+                os.remove('cloudflare_update_record_ip4.txt')
+            duration, requests, failed = run_scenario(server, configs, local_cache)
+            durations.append(duration)
+        api_requests = sum(count for endpoint, count in requests.items() if not endpoint.startswith('provider') and endpoint != 'rate_limited')
+        provider_requests = sum(count for endpoint, count in requests.items() if endpoint.startswith('provider'))
+        results.append({
+            'setup': label,
+            'scenario': name,
+            'records': len(configs),
+            'api_requests': api_requests,
+            'api_requests_per_update': api_requests / len(configs),
+            'provider_requests': provider_requests,
+            'rate_limited': requests['rate_limited'],
+            'failed': failed,
+            'wall_time': sum(durations) / len(durations),
+            'endpoints': {endpoint: count for endpoint, count in requests.items() if endpoint != 'rate_limited'},
+        })
+    return results
+
+
+def print_results(results):
+    print(f'{"setup":<14}{"scenario":<18}{"records":>8}{"api req":>9}{"req/upd":>9}{"provider":>10}{"429":>6}{"failed":>8}{"wall ms":>10}')
+    for result in results:
+        print(f'{result["setup"]:<14}{result["scenario"]:<18}{result["records"]:>8}{result["api_requests"]:>9}{result["api_requests_per_update"]:>9.2f}'
+              f'{result["provider_requests"]:>10}{result["rate_limited"]:>6}{result["failed"]:>8}{result["wall_time"] * 1000:>10.1f}')
+    print()
+    for result in results:
+        print(f'{result["setup"]} / {result["scenario"]}: {result["endpoints"]}')
+
+
+def main():
+    args = setup_parser()
+    logging.disable(logging.CRITICAL)
+    results = []
+    old_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # cloudflare_update_record.py keeps its local IP cache in the current directory
+        os.chdir(work_dir)
+        try:
+            for label, record_count in (('single-record', 1), ('many-record', args.records)):
+                cloudflare = FakeCloudflare(ipv4=NEW_IP, rate_limit_every=args.rate_limit_every, retry_after=0, latency=args.latency)
+                configs = write_configs(cloudflare, record_count, work_dir)
+                with FakeCloudflareServer(cloudflare) as server:
+                    results += benchmark(server, configs, label, args.rounds)
+        finally:
+            os.chdir(old_cwd)
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
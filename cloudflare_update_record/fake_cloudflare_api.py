@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# In-process stand-in for the parts of the Cloudflare v4 API used by cloudflare_update_record.py
+# plus a fake external IP address provider, so the script can be load- and regression-tested offline.
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+from collections import Counter
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'fake_server'))
+import fake_server
+
+
+API_PREFIX = '/client/v4'
+RATE_LIMIT_ERROR = {'code': 971, 'message': 'Please wait and consider throttling your request speed'}
+
+
+class FakeCloudflare:
+    ''' Zones, DNS records, tokens and request statistics of the fake API '''
+
+    def __init__(self, read_token='read-token', edit_token='edit-token', ipv4='192.0.2.1', ipv6='2001:db8::1', rate_limit_every=0, retry_after=1, latency=0.0):
+        self.read_token = read_token
+        self.edit_token = edit_token
+        self.ips = {4: ipv4, 6: ipv6}
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.latency = latency
+        self.zones = {}
+        self.records = {}
+        self.requests = Counter()
+        self.api_request_count = 0
+        self.lock = threading.Lock()
+
+    def add_zone(self, zone_name):
+        ''' Add zone and return its ID, existing zones are reused '''
+        for zone_id, name in self.zones.items():
+            if name == zone_name:
+                return zone_id
+        zone_id = uuid.uuid4().hex
+        self.zones[zone_id] = zone_name
+        self.records[zone_id] = {}
+        return zone_id
+
+    def add_record(self, zone_name, name, record_type, content):
+        ''' Add DNS record to zone (created if missing) and return record ID, name is the fully qualified record name '''
+        zone_id = self.add_zone(zone_name)
+        record_id = uuid.uuid4().hex
+        self.records[zone_id][record_id] = {'id': record_id, 'zone_id': zone_id, 'zone_name': zone_name, 'name': name, 'type': record_type, 'content': content, 'proxied': False, 'ttl': 1}
+        return record_id
+
+    def get_record(self, zone_name, name, record_type):
+        for zone_id, zone in self.zones.items():
+            if zone == zone_name:
+                for record in self.records[zone_id].values():
+                    if record['name'] == name and record['type'] == record_type:
+                        return record
+        return None
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests.clear()
+            self.api_request_count = 0
+
+    def count(self, endpoint):
+        ''' Count request and return True if it should be answered with a rate limit error '''
+        with self.lock:
+            self.requests[endpoint] += 1
+            if not endpoint.startswith('provider'):
+                self.api_request_count += 1
+                if self.rate_limit_every and self.api_request_count % self.rate_limit_every == 0:
+                    self.requests['rate_limited'] += 1
+                    return True
+        return False
+
+
+def paginate(items, query, default_per_page, max_per_page):
+    ''' Slice items according to page/per_page query parameters and build Cloudflare style result_info '''
+    page = max(int(query.get('page', ['1'])[0]), 1)
+    per_page = min(max(int(query.get('per_page', [str(default_per_page)])[0]), 1), max_per_page)
+    total_pages = max((len(items) + per_page - 1) // per_page, 1)
+    result = items[(page - 1) * per_page:page * per_page]
+    result_info = {'page': page, 'per_page': per_page, 'count': len(result), 'total_count': len(items), 'total_pages': total_pages}
+    return result, result_info
+
+
+def make_handler(cloudflare):
+    class Handler(fake_server.FakeRequestHandler):
+        def send_json(self, status, body, headers=None):
+            self.send_body(status, json.dumps(body), 'application/json', headers)
+
+        def send_error_json(self, status, code, message, headers=None):
+            self.send_json(status, {'success': False, 'errors': [{'code': code, 'message': message}], 'messages': [], 'result': None}, headers)
+
+        def authorized(self, allowed_tokens):
+            return self.headers.get('Authorization') in [f'Bearer {token}' for token in allowed_tokens]
+
+        def route(self, method, body=b''):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            parts = [part for part in url.path.split('/') if part]
+            if cloudflare.latency:
+                time.sleep(cloudflare.latency)
+
+            if method == 'GET' and url.path in ('/ipv4', '/ipv6'):
+                cloudflare.count(f'provider {url.path}')
+                self.send_body(200, f'{cloudflare.ips[int(url.path[-1])]}\n')
+                return
+            if not url.path.startswith(API_PREFIX):
+                self.send_error_json(404, 7000, 'No route for that URI')
+                return
+            parts = parts[2:]
+
+            if method == 'GET' and parts == ['zones']:
+                endpoint = 'GET /zones'
+            elif method == 'GET' and len(parts) == 3 and parts[0] == 'zones' and parts[2] == 'dns_records':
+                endpoint = 'GET /zones/:zone/dns_records'
+            elif method == 'PUT' and len(parts) == 4 and parts[0] == 'zones' and parts[2] == 'dns_records':
+                endpoint = 'PUT /zones/:zone/dns_records/:record'
+            else:
+                self.send_error_json(404, 7000, 'No route for that URI')
+                return
+
+            if cloudflare.count(endpoint):
+                self.send_json(429, {'success': False, 'errors': [RATE_LIMIT_ERROR], 'messages': [], 'result': None}, {'Retry-After': str(cloudflare.retry_after)})
+                return
+
+            if method == 'GET':
+                if not self.authorized([cloudflare.read_token, cloudflare.edit_token]):
+                    self.send_error_json(403, 10000, 'Authentication error')
+                    return
+            elif not self.authorized([cloudflare.edit_token]):
+                self.send_error_json(403, 10000, 'Authentication error')
+                return
+
+            if endpoint == 'GET /zones':
+                zones = [{'id': zone_id, 'name': name, 'status': 'active'} for zone_id, name in cloudflare.zones.items() if 'name' not in query or name == query['name'][0]]
+                result, result_info = paginate(zones, query, 20, 50)
+                self.send_json(200, {'success': True, 'errors': [], 'messages': [], 'result': result, 'result_info': result_info})
+                return
+
+            zone_id = parts[1]
+            if zone_id not in cloudflare.zones:
+                self.send_error_json(404, 7003, f'Could not route to /zones/{zone_id}, perhaps your object identifier is invalid?')
+                return
+
+            if endpoint == 'GET /zones/:zone/dns_records':
+                records = [record for record in cloudflare.records[zone_id].values()
+                           if ('name' not in query or record['name'] == query['name'][0]) and ('type' not in query or record['type'] == query['type'][0])]
+                result, result_info = paginate(records, query, 100, 5000)
+                self.send_json(200, {'success': True, 'errors': [], 'messages': [], 'result': result, 'result_info': result_info})
+                return
+
+            record_id = parts[3]
+            if record_id not in cloudflare.records[zone_id]:
+                self.send_error_json(404, 81044, 'Record does not exist.')
+                return
+            try:
+                body = json.loads(body)
+            except ValueError:
+                self.send_error_json(400, 9207, 'Request body is invalid.')
+                return
+            record = cloudflare.records[zone_id][record_id]
+            if body.get('type') != record['type'] or not body.get('content'):
+                self.send_error_json(400, 9000, 'DNS name is invalid or record type does not match.')
+                return
+            zone_name = cloudflare.zones[zone_id]
+            name = body.get('name', record['name'])
+            if name == '@':
+                name = zone_name
+            elif not name.endswith(zone_name):
+                name = f'{name}.{zone_name}'
+            with cloudflare.lock:
+                record.update({'name': name, 'content': body['content']})
+            self.send_json(200, {'success': True, 'errors': [], 'messages': [], 'result': record})
+
+        def do_GET(self):
+            self.route('GET')
+
+        def do_PUT(self):
+            self.route('PUT', self.read_body())
+
+    return Handler
+
+
+class FakeCloudflareServer(fake_server.FakeServer):
+    ''' Runs the fake API in a background thread, usable as context manager '''
+
+    def __init__(self, cloudflare, host='127.0.0.1', port=0):
+        super().__init__(make_handler(cloudflare), host, port)
+        self.cloudflare = cloudflare
+
+    @property
+    def api_url(self):
+        return f'{self.base_url}{API_PREFIX}'
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser(description='Run a fake Cloudflare v4 API and IP provider for cloudflare_update_record.py')
+    parser.add_argument('-p', '--port', help='Port to listen on', type=int, default=8080)
+    parser.add_argument('-r', '--record', help='DNS record to serve as <zone>:<fqdn>:<type>:<content>, can be given multiple times', action='append', default=[])
+    parser.add_argument('-4', '--ipv4', help='IPv4 address returned by /ipv4', default='192.0.2.1')
+    parser.add_argument('-6', '--ipv6', help='IPv6 address returned by /ipv6', default='2001:db8::1')
+    parser.add_argument('-rt', '--read-token', help='Accepted read token', default='read-token')
+    parser.add_argument('-et', '--edit-token', help='Accepted edit token', default='edit-token')
+    parser.add_argument('-rl', '--rate-limit-every', help='Answer every n-th API request with 429, 0 to disable', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = setup_parser()
+    cloudflare = FakeCloudflare(read_token=args.read_token, edit_token=args.edit_token, ipv4=args.ipv4, ipv6=args.ipv6, rate_limit_every=args.rate_limit_every)
+    for record in args.record:
+        zone_name, name, record_type, content = record.split(':', 3)
+        cloudflare.add_record(zone_name, name, record_type, content)
+    server = FakeCloudflareServer(cloudflare, port=args.port)
+    print(f'Serving fake Cloudflare API at {server.api_url} and IP provider at {server.base_url}/ipv4 and {server.base_url}/ipv6')
+    server.serve_forever(cloudflare.requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Python variant of cping.sh: watches many host:port targets concurrently with non-blocking TCP connects instead of
+# one nmap scan per second, exits once all (or any) targets are reachable and reports time to recovery and connect
+# latency percentiles per target.
+
+import argparse
+import asyncio
+import logging
+import math
+import sys
+import time
+
+
+log_levels = {'crit': logging.CRITICAL, 'warn': logging.WARN, 'info': logging.INFO, 'debug': logging.DEBUG}
+reported_percentiles = [50, 90, 99]
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('targets', nargs='+', help='Targets as host:port, IPv6 addresses as [address]:port')
+    parser.add_argument('-t', '--timeout', help='Connect timeout in seconds', type=float, default=1.0)
+    parser.add_argument('-i', '--interval', help='Seconds between connects to a target', type=float, default=1.0)
+    parser.add_argument('-b', '--backoff', help='Multiply the interval of a target by this after each failed connect', type=float, default=1.0)
+    parser.add_argument('-mi', '--max-interval', help='Upper limit for the interval with backoff in seconds', type=float, default=30.0)
+    parser.add_argument('-m', '--mode', help='Exit once all or any of the targets are reachable', choices=['all', 'any'], default='all')
+    parser.add_argument('-wd', '--wait-down', help='Only count targets as recovered after they were unreachable once, e.g. when starting before a restart', action='store_true')
+    parser.add_argument('-d', '--deadline', help='Give up after this many seconds and exit with 1', type=float)
+    parser.add_argument('-c', '--concurrency', help='Maximum number of connects in flight', type=int, default=256)
+    parser.add_argument('-v', '--log-level', help=f'Log level, possible choices: {list(log_levels)}', default='info')
+    args = parser.parse_args()
+    return args
+
+
+def setup_logging(args):
+    ''' Set log level '''
+    if args.log_level not in log_levels:
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=log_levels['info'])
+        logging.warning(f'Specified log level "{args.log_level}" is not allowed, see output of -h for possible values')
+    else:
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=log_levels[args.log_level])
+        logging.debug(f'Set log level "{args.log_level}"')
+
+
+class Target:
+    def __init__(self, target):
+        host, separator, port = target.rpartition(':')
+        if not separator or not port.isdigit():
+            raise ValueError(f'Target "{target}" is not in host:port format')
+        self.name = target
+        self.host = host.strip('[]')
+        self.port = int(port)
+        self.attempts = 0
+        self.latencies = []
+        self.up = False
+        self.was_down = False
+        self.down_since = None
+        self.recovered_after = None
+
+
+def percentile(values, percent):
+    ''' Nearest-rank percentile of unsorted values '''
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+async def connect(target, timeout, slots):
+    ''' Returns connect latency in seconds or None if the target is unreachable '''
+    async with slots:
+        start = time.monotonic()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(target.host, target.port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        latency = time.monotonic() - start
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return latency
+
+
+async def watch_target(target, args, slots, changed):
+    interval = args.interval
+    while True:
+        # a failed connect can take up to the timeout, the target was down since the attempt started
+        attempt_start = time.monotonic()
+        latency = await connect(target, args.timeout, slots)
+        target.attempts += 1
+        now = time.monotonic()
+        if latency is None:
+            if target.up:
+                logging.warning(f'{target.name} is unreachable again')
+                target.up = False
+            if target.down_since is None:
+                target.down_since = attempt_start
+            target.was_down = True
+            logging.debug(f'{target.name} unreachable, attempt {target.attempts}')
+            interval = min(interval * args.backoff, args.max_interval)
+        else:
+            target.latencies.append(latency)
+            if not target.up and (target.was_down or not args.wait_down):
+                target.up = True
+                target.recovered_after = now - target.down_since if target.down_since is not None else 0.0
+                target.down_since = None
+                logging.info(f'{target.name} is reachable now (recovered after {target.recovered_after:.1f}s, {target.attempts} attempts)')
+                changed.set()
+            interval = args.interval
+        await asyncio.sleep(interval)
+
+
+async def watch(targets, args):
+    ''' Returns True once the targets are reachable according to the mode, False if the deadline passed first '''
+    slots = asyncio.Semaphore(args.concurrency)
+    changed = asyncio.Event()
+    done = all if args.mode == 'all' else any
+    tasks = [asyncio.create_task(watch_target(target, args, slots, changed)) for target in targets]
+    deadline = time.monotonic() + args.deadline if args.deadline else None
+    try:
+        while not done(target.up for target in targets):
+            changed.clear()
+            timeout = deadline - time.monotonic() if deadline else None
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def report(targets):
+    for target in targets:
+        state = f'up, recovered after {target.recovered_after:.1f}s' if target.up else 'down'
+        if target.latencies:
+            latencies = ', '.join(f'p{percent} {percentile(target.latencies, percent) * 1000:.1f}ms' for percent in reported_percentiles)
+            latencies = f'connect latency {latencies} ({len(target.latencies)} samples)'
+        else:
+            latencies = 'no successful connects'
+        print(f'{target.name}: {state}, {target.attempts} attempts, {latencies}')
+
+
+def main():
+    args = setup_parser()
+    setup_logging(args)
+    try:
+        targets = [Target(target) for target in args.targets]
+    except ValueError as e:
+        logging.critical(e)
+        sys.exit(2)
+    logging.info(f'Started watching {len(targets)} targets')
+    try:
+        reachable = asyncio.run(watch(targets, args))
+    except KeyboardInterrupt:
+        report(targets)
+        sys.exit(130)
+    report(targets)
+    if not reachable:
+        logging.error(f'Deadline of {args.deadline}s passed before {args.mode} targets were reachable')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,33 @@
 import argparse
 import caldav # python3-caldav
 import datetime
+import json
 import logging
+import os
 import pytz
+import requests
 import vobject
+import xml.etree.ElementTree as ET
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from xml.sax.saxutils import escape
+
+
+DAV_NS = '{DAV:}'
+CALDAV_NS = '{urn:ietf:params:xml:ns:caldav}'
+CS_NS = '{http://calendarserver.org/ns/}'
+SYNC_COLLECTION_QUERY = '<?xml version="1.0" encoding="utf-8"?><d:sync-collection xmlns:d="DAV:"><d:sync-token>{sync_token}</d:sync-token><d:sync-level>1</d:sync-level><d:prop><d:getetag/></d:prop></d:sync-collection>'
+CTAG_QUERY = '<?xml version="1.0" encoding="utf-8"?><d:propfind xmlns:d="DAV:" xmlns:cs="http://calendarserver.org/ns/"><d:prop><cs:getctag/></d:prop></d:propfind>'
+ETAG_QUERY = '<?xml version="1.0" encoding="utf-8"?><d:propfind xmlns:d="DAV:"><d:prop><d:getetag/></d:prop></d:propfind>'
+MULTIGET_QUERY = '<?xml version="1.0" encoding="utf-8"?><c:calendar-multiget xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav"><d:prop><d:getetag/><c:calendar-data/></d:prop>{hrefs}</c:calendar-multiget>'
+# number of events fetched per calendar-multiget request
+MULTIGET_BATCH_SIZE = 100
+# expanded occurrences are indexed for this many days before and after the day the index is built
+INDEX_DAYS_BEFORE = 31
+INDEX_DAYS_AFTER = 366
+# bumped when the layout of the occurrence index changes, older indexes are rebuilt
+INDEX_VERSION = 2
 
 
 def setup_parser():
@@ -16,6 +40,12 @@ def setup_parser():
     parser.add_argument('-c', '--calendars', help='List of calendar (names) to be checked, space-separated', required=True, nargs="*", default=[])
     parser.add_argument('-t', '--timezone', help='Timezone', default="Europe/Berlin")
     parser.add_argument('-l', '--log-file', help='Log file to use', type=str, required=False, default='events_today.log')
+    parser.add_argument('-w', '--workers', help='Number of calendars to query concurrently', type=int, default=8)
+    parser.add_argument('-d', '--days', help='Number of days to print events for, starting at start date', type=int, default=1)
+    parser.add_argument('-sd', '--start-date', help='First day to print events for as YYYY-MM-DD, defaults to today', type=datetime.date.fromisoformat)
+    parser.add_argument('-cf', '--cache-file', help='Local cache of calendar URLs, events and sync state', type=str, default='events_today_cache.json')
+    parser.add_argument('-nc', '--no-cache', help='Query the server directly without local cache', action='store_true')
+    parser.add_argument('-o', '--offline', help='Answer from the local cache only, without syncing with the server', action='store_true')
     args = parser.parse_args()
     return args
 
@@ -42,15 +72,27 @@ def get_calendars(client):
     return calendars
 
 
-def get_vcal_events(calendars, timezone, calendars_to_be_checked):
-    today = datetime.datetime.now(pytz.timezone(timezone)).replace(hour=0, minute=0, second=0, microsecond=0)
+def search_calendar(calendar, start, end):
+    logging.info(f'Configured calendar "{calendar.name}" was found, getting events...')
+    return calendar.date_search(start, end=end)
+
+
+def get_start_day(timezone, start_date):
+    start = datetime.datetime.now(pytz.timezone(timezone))
+    if start_date:
+        start = pytz.timezone(timezone).localize(datetime.datetime.combine(start_date, datetime.time()))
+    return start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_vcal_events(calendars, timezone, calendars_to_be_checked, workers, days=1, start_date=None):
+    today = get_start_day(timezone, start_date)
 
     if calendars:
         all_vcal_events = {}
-        for calendar in calendars:
-            if calendar.name in calendars_to_be_checked:
-                logging.info(f'Configured calendar "{calendar.name}" was found, getting events...')
-                vcal_events = calendar.date_search(today, end=today + datetime.timedelta(days=1))
+        calendars_to_search = [calendar for calendar in calendars if calendar.name in calendars_to_be_checked]
+        # query all calendars at once so total latency is that of the slowest calendar
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for calendar, vcal_events in zip(calendars_to_search, executor.map(lambda calendar: search_calendar(calendar, today, today + datetime.timedelta(days=days)), calendars_to_search)):
                 if vcal_events:
                     all_vcal_events[calendar.name] = vcal_events
                 #all_vcal_events[calendar.name] = calendar.date_search(today + datetime.timedelta(days=1), end=today + datetime.timedelta(days=2))
@@ -66,8 +108,9 @@ def get_vcal_events(calendars, timezone, calendars_to_be_checked):
         exit(1)
 
 
-def decode_vcal_events(vcal_events):
+def decode_vcal_events(vcal_events, timezone):
     logging.info('Processing vcal events...')
+    tz = pytz.timezone(timezone)
     decoded_events = {}
     for calendar_name in vcal_events.keys():
         decoded_events[calendar_name] = []
@@ -76,12 +119,267 @@ def decode_vcal_events(vcal_events):
             for component in read_event.components():
                 if component.name == 'VEVENT':
                     event_summary = component.summary.valueRepr()
-                    event_start = component.dtstart.valueRepr()
-                    decoded_events[calendar_name].append(f'{event_summary} starting at {event_start.strftime("%Y-%-m-%d %H:%M")}')
+                    event_start = to_local_datetime(component.dtstart.value, tz)
+                    decoded_events[calendar_name].append(f'{event_summary} starting at {format_event_start(event_start)}')
                     logging.info(f'Added event from calendar "{calendar_name}"')
     return decoded_events
 
 
+def load_cache(args):
+    try:
+        with open(args.cache_file, 'r', encoding='UTF-8') as f:
+            cache = json.load(f)
+        if cache.get('url') == args.url and cache.get('user') == args.user:
+            logging.info(f'Loaded cache "{args.cache_file}"')
+            return cache
+        logging.info(f'Cache "{args.cache_file}" belongs to another server or user, starting with empty cache')
+    except FileNotFoundError:
+        logging.info(f'No cache found at "{args.cache_file}", starting with empty cache')
+    except ValueError:
+        logging.warning(f'Cache "{args.cache_file}" is corrupt, starting with empty cache')
+    return {'url': args.url, 'user': args.user, 'calendars': {}, 'index': None}
+
+
+def save_cache(cache, args):
+    # write to temp file first so an interrupted run can't leave a truncated cache behind
+    with open(f'{args.cache_file}.tmp', 'w', encoding='UTF-8') as f:
+        json.dump(cache, f)
+    os.replace(f'{args.cache_file}.tmp', args.cache_file)
+    logging.info(f'Saved cache "{args.cache_file}"')
+
+
+def get_dav_session(args):
+    session = requests.Session()
+    session.auth = (args.user, args.password)
+    session.headers.update({'Content-Type': 'application/xml; charset=utf-8'})
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def parse_multistatus(content, base_url):
+    ''' Return responses of a WebDAV multistatus as dicts with absolute href, status, etag and calendar data plus the sync token if any '''
+    root = ET.fromstring(content)
+    responses = []
+    for response in root.findall(f'{DAV_NS}response'):
+        item = {'href': urljoin(base_url, response.findtext(f'{DAV_NS}href').strip()), 'status': response.findtext(f'{DAV_NS}status'), 'etag': None, 'calendar_data': None, 'ctag': None}
+        for propstat in response.findall(f'{DAV_NS}propstat'):
+            if ' 200 ' not in propstat.findtext(f'{DAV_NS}status', ''):
+                continue
+            prop = propstat.find(f'{DAV_NS}prop')
+            item['status'] = propstat.findtext(f'{DAV_NS}status')
+            item['etag'] = prop.findtext(f'{DAV_NS}getetag')
+            item['calendar_data'] = prop.findtext(f'{CALDAV_NS}calendar-data')
+            item['ctag'] = prop.findtext(f'{CS_NS}getctag')
+        responses.append(item)
+    return responses, root.findtext(f'{DAV_NS}sync-token')
+
+
+def get_changes_by_sync_token(session, calendar_cache):
+    ''' Use sync-collection REPORT to get changed and deleted hrefs, returns None if the server doesn't support it '''
+    url = calendar_cache['url']
+    sync_token = calendar_cache.get('sync_token')
+    response = session.request('REPORT', url, data=SYNC_COLLECTION_QUERY.format(sync_token=escape(sync_token or '')), headers={'Depth': '0'})
+    if response.status_code != 207:
+        if sync_token and response.status_code in (403, 409, 412):
+            logging.info(f'Sync token of calendar "{url}" is no longer valid, doing full sync')
+            calendar_cache['sync_token'] = None
+            return get_changes_by_sync_token(session, calendar_cache)
+        logging.info(f'Server does not support sync-collection for calendar "{url}" (status {response.status_code}), falling back to ctag')
+        return None
+    items, new_sync_token = parse_multistatus(response.content, url)
+    events = calendar_cache['events']
+    changed = [item['href'] for item in items if item['etag'] and item['href'] != url and events.get(item['href'], {}).get('etag') != item['etag']]
+    deleted = [item['href'] for item in items if not item['etag'] and item['status'] and ' 404 ' in item['status']]
+    if not sync_token:
+        # initial sync lists all events, everything else in the cache is gone
+        listed = {item['href'] for item in items}
+        deleted = [href for href in events if href not in listed]
+    calendar_cache['sync_token'] = new_sync_token
+    return changed, deleted
+
+
+def get_changes_by_ctag(session, calendar_cache):
+    ''' Check ctag of calendar and compare ETags of all events if it changed '''
+    url = calendar_cache['url']
+    response = session.request('PROPFIND', url, data=CTAG_QUERY, headers={'Depth': '0'})
+    ctag = None
+    if response.status_code == 207:
+        items, sync_token = parse_multistatus(response.content, url)
+        ctag = items[0]['ctag'] if items else None
+    if ctag and ctag == calendar_cache.get('ctag'):
+        return [], []
+    response = session.request('PROPFIND', url, data=ETAG_QUERY, headers={'Depth': '1'})
+    response.raise_for_status()
+    items, sync_token = parse_multistatus(response.content, url)
+    etags = {item['href']: item['etag'] for item in items if item['etag'] and item['href'] != url}
+    events = calendar_cache['events']
+    calendar_cache['ctag'] = ctag
+    return [href for href, etag in etags.items() if events.get(href, {}).get('etag') != etag], [href for href in events if href not in etags]
+
+
+def sync_calendar(session, calendar_name, calendar_cache):
+    ''' Bring cached events of calendar up to date, only downloading changed events. Returns whether anything changed. '''
+    changes = None
+    if calendar_cache.get('sync_token') is not False:
+        changes = get_changes_by_sync_token(session, calendar_cache)
+        if changes is None:
+            calendar_cache['sync_token'] = False
+    if changes is None:
+        changes = get_changes_by_ctag(session, calendar_cache)
+    changed, deleted = changes
+    events = calendar_cache['events']
+    for href in deleted:
+        events.pop(href, None)
+    for i in range(0, len(changed), MULTIGET_BATCH_SIZE):
+        hrefs = ''.join(f'<d:href>{escape(href)}</d:href>' for href in changed[i:i + MULTIGET_BATCH_SIZE])
+        response = session.request('REPORT', calendar_cache['url'], data=MULTIGET_QUERY.format(hrefs=hrefs), headers={'Depth': '1'})
+        response.raise_for_status()
+        items, sync_token = parse_multistatus(response.content, calendar_cache['url'])
+        for item in items:
+            if item['calendar_data']:
+                events[item['href']] = {'etag': item['etag'], 'data': item['calendar_data']}
+    logging.info(f'Synced calendar "{calendar_name}": {len(changed)} events changed, {len(deleted)} deleted')
+    return bool(changed or deleted)
+
+
+def discover_calendars(cache, args):
+    ''' Look up URLs of configured calendars which aren't cached yet '''
+    missing = [name for name in args.calendars if name not in cache['calendars']]
+    if not missing:
+        return
+    logging.info(f'Calendars {missing} are not cached yet, discovering calendars')
+    client = get_caldav_client(args)
+    calendars = get_calendars(client)
+    if not calendars:
+        logging.critical("No calendars found. Exiting...")
+        exit(1)
+    for calendar in calendars:
+        if calendar.name in missing:
+            cache['calendars'][calendar.name] = {'url': str(calendar.url), 'sync_token': None, 'ctag': None, 'events': {}}
+    if not any(name in cache['calendars'] for name in args.calendars):
+        logging.critical('No calendars with the specified names could be found on the server. Exiting...')
+        exit(1)
+
+
+def sync_calendars(cache, args):
+    ''' Sync all configured calendars concurrently, rebuild the occurrence index if anything changed '''
+    discover_calendars(cache, args)
+    session = get_dav_session(args)
+    calendar_names = [name for name in args.calendars if name in cache['calendars']]
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        changed = list(executor.map(lambda name: sync_calendar(session, name, cache['calendars'][name]), calendar_names))
+    if any(changed):
+        cache['index'] = None
+
+
+def to_local_datetime(value, tz):
+    ''' Convert DTSTART values (dates, naive or aware datetimes) to datetimes in the local timezone '''
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    if value.tzinfo is None:
+        return tz.localize(value)
+    return value.astimezone(tz)
+
+
+def format_event_start(value):
+    ''' Format local start datetime of an event for output, the same in cached and --no-cache mode '''
+    return value.strftime("%Y-%-m-%d %H:%M")
+
+
+def get_duration(component, tz):
+    ''' Duration of VEVENT from DTEND or DURATION, defaults to one day for all-day events and zero otherwise (RFC 5545) '''
+    dtstart = component.dtstart.value
+    if hasattr(component, 'dtend'):
+        return to_local_datetime(component.dtend.value, tz) - to_local_datetime(dtstart, tz)
+    if hasattr(component, 'duration'):
+        return component.duration.value
+    return datetime.timedelta(days=0 if isinstance(dtstart, datetime.datetime) else 1)
+
+
+def get_occurrences(component, start, end, tz):
+    ''' Expand (recurring) VEVENT into (start, end) local datetimes of occurrences overlapping [start, end) '''
+    dtstart = component.dtstart.value
+    duration = get_duration(component, tz)
+    if not hasattr(component, 'rrule') and not hasattr(component, 'rdate'):
+        occurrences = [to_local_datetime(dtstart, tz)]
+    else:
+        rruleset = component.getrruleset(addRDate=True)
+        # search a day more on both ends and one duration earlier for occurrences still running at start,
+        # exact filtering happens on the local datetimes below
+        search_start = start - duration - datetime.timedelta(days=1)
+        search_end = end + datetime.timedelta(days=1)
+        # all-day and floating events are expanded with naive datetimes
+        naive = not isinstance(dtstart, datetime.datetime) or dtstart.tzinfo is None
+        if naive:
+            search_start, search_end = search_start.replace(tzinfo=None), search_end.replace(tzinfo=None)
+        occurrences = rruleset.between(search_start, search_end, inc=True)
+        if not naive and hasattr(dtstart.tzinfo, 'localize'):
+            # pytz timezones keep the UTC offset of DTSTART while expanding, localize the wall clock time again to follow DST changes
+            occurrences = [dtstart.tzinfo.localize(occurrence.replace(tzinfo=None)) for occurrence in occurrences]
+        occurrences = [to_local_datetime(occurrence, tz) for occurrence in occurrences]
+    # events without duration are treated as instants
+    return [(occurrence, occurrence + duration) for occurrence in occurrences
+            if occurrence < end and (occurrence + duration > start or start <= occurrence)]
+
+
+def index_event_data(event_data, start, end, timezone):
+    ''' Return (day, summary, ISO local start) for every day within [start, end) that occurrences of events in iCalendar data overlap '''
+    tz = pytz.timezone(timezone)
+    entries = []
+    read_event = vobject.readOne(event_data)
+    vevents = [component for component in read_event.components() if component.name == 'VEVENT']
+    # occurrences modified via RECURRENCE-ID are separate VEVENTs and replace the expanded ones
+    overridden = {to_local_datetime(component.recurrence_id.value, tz) for component in vevents if hasattr(component, 'recurrence_id')}
+    for component in vevents:
+        summary = component.summary.valueRepr() if hasattr(component, 'summary') else ''
+        for occurrence, occurrence_end in get_occurrences(component, start, end, tz):
+            if not hasattr(component, 'recurrence_id') and occurrence in overridden:
+                continue
+            # multi-day events show up on every day they overlap, the end is exclusive
+            first_day = max(occurrence, start).date()
+            last_day = (min(occurrence_end, end) - datetime.timedelta(microseconds=1)).date() if occurrence_end > occurrence else first_day
+            for day_offset in range((last_day - first_day).days + 1):
+                entries.append(((first_day + datetime.timedelta(days=day_offset)).isoformat(), summary, occurrence.isoformat()))
+    return entries
+
+
+def build_index(cache, args):
+    ''' Pre-index expanded occurrences of all cached events by day '''
+    today = get_start_day(args.timezone, None)
+    start = min(today, get_start_day(args.timezone, args.start_date)) - datetime.timedelta(days=INDEX_DAYS_BEFORE)
+    end = max(today, get_start_day(args.timezone, args.start_date) + datetime.timedelta(days=args.days)) + datetime.timedelta(days=INDEX_DAYS_AFTER)
+    logging.info(f'Building occurrence index from {start.date()} to {end.date()}')
+    # days and start times in the index are local to the timezone it was built with, start times are ISO so they sort chronologically
+    index = {'version': INDEX_VERSION, 'start': start.date().isoformat(), 'end': end.date().isoformat(), 'timezone': args.timezone, 'days': {}}
+    for calendar_name, calendar_cache in cache['calendars'].items():
+        for event in calendar_cache['events'].values():
+            for day, summary, event_start in index_event_data(event['data'], start, end, args.timezone):
+                index['days'].setdefault(day, {}).setdefault(calendar_name, []).append([event_start, summary])
+    cache['index'] = index
+
+
+def get_events_from_index(cache, args):
+    ''' Answer the requested day range from the occurrence index, rebuilding it if missing, too small or built for another timezone '''
+    first_day = get_start_day(args.timezone, args.start_date).date()
+    last_day = first_day + datetime.timedelta(days=args.days - 1)
+    index = cache.get('index')
+    if not index or index.get('version') != INDEX_VERSION or index.get('timezone') != args.timezone or first_day.isoformat() < index['start'] or last_day.isoformat() >= index['end']:
+        build_index(cache, args)
+        index = cache['index']
+    events = {}
+    for calendar_name in args.calendars:
+        for day_offset in range(args.days):
+            day = (first_day + datetime.timedelta(days=day_offset)).isoformat()
+            for event_start, summary in sorted(index['days'].get(day, {}).get(calendar_name, [])):
+                event = f'{summary} starting at {format_event_start(datetime.datetime.fromisoformat(event_start))}'
+                # multi-day events are indexed on every day they overlap, but listed once like in --no-cache mode
+                if event not in events.get(calendar_name, []):
+                    events.setdefault(calendar_name, []).append(event)
+    return events
+
+
 def print_events(events):
     for calendar in events.keys():
         logging.info(f'Printing decoded events from calendar "{calendar}"')
@@ -93,10 +391,17 @@ def print_events(events):
 def main():
     args = setup_parser()
     setup_logging(args)
-    client = get_caldav_client(args)
-    calendars = get_calendars(client)
-    vcal_events = get_vcal_events(calendars, args.timezone, args.calendars)
-    decoded_events = decode_vcal_events(vcal_events)
+    if args.no_cache:
+        client = get_caldav_client(args)
+        calendars = get_calendars(client)
+        vcal_events = get_vcal_events(calendars, args.timezone, args.calendars, args.workers, args.days, args.start_date)
+        decoded_events = decode_vcal_events(vcal_events, args.timezone)
+    else:
+        cache = load_cache(args)
+        if not args.offline:
+            sync_calendars(cache, args)
+        decoded_events = get_events_from_index(cache, args)
+        save_cache(cache, args)
     print_events(decoded_events)
 
 
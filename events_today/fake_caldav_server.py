@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+# Minimal local CalDAV stand-in (principal/calendar discovery, PROPFIND with ctag/ETags, sync-collection and
+# calendar-multiget REPORTs) to test and benchmark events_today.py without a real server.
+
+import argparse
+import base64
+import hashlib
+import os
+import sys
+import threading
+import uuid
+import xml.etree.ElementTree as ET
+
+from collections import Counter
+from urllib.parse import unquote, urlparse
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'fake_server'))
+import fake_server
+
+
+DAV_NS = '{DAV:}'
+CALDAV_NS = '{urn:ietf:params:xml:ns:caldav}'
+SYNC_TOKEN_PREFIX = 'http://fake-caldav/sync/'
+
+
+class FakeCalDAV:
+    ''' Calendars, events, change log and request statistics of the fake server '''
+
+    def __init__(self, user='user', password='password', sync_collection=True):
+        self.user = user
+        self.password = password
+        self.sync_collection = sync_collection
+        self.calendars = {}
+        self.revision = 0
+        # (revision, calendar path, event path) of every change, deleted events have no entry in the calendar anymore
+        self.changes = []
+        self.requests = Counter()
+        self.lock = threading.RLock()
+
+    @property
+    def principal_path(self):
+        return f'/principals/{self.user}/'
+
+    @property
+    def home_path(self):
+        return f'/calendars/{self.user}/'
+
+    def add_calendar(self, name):
+        ''' Add calendar with given display name and return its path '''
+        with self.lock:
+            path = f'{self.home_path}{uuid.uuid4().hex}/'
+            self.calendars[path] = {'name': name, 'events': {}}
+            return path
+
+    def get_calendar_path(self, name):
+        for path, calendar in self.calendars.items():
+            if calendar['name'] == name:
+                return path
+        return None
+
+    def put_event(self, calendar_name, ics, event_id=None):
+        ''' Add or replace event in calendar and return its path '''
+        with self.lock:
+            calendar_path = self.get_calendar_path(calendar_name) or self.add_calendar(calendar_name)
+            event_path = f'{calendar_path}{event_id or uuid.uuid4().hex}.ics'
+            self.revision += 1
+            etag = f'"{hashlib.sha1(f"{self.revision}{ics}".encode("UTF-8")).hexdigest()}"'
+            self.calendars[calendar_path]['events'][event_path] = {'etag': etag, 'data': ics}
+            self.changes.append((self.revision, calendar_path, event_path))
+            return event_path
+
+    def delete_event(self, event_path):
+        with self.lock:
+            for calendar_path, calendar in self.calendars.items():
+                if calendar['events'].pop(event_path, None):
+                    self.revision += 1
+                    self.changes.append((self.revision, calendar_path, event_path))
+                    return True
+        return False
+
+    def get_ctag(self, calendar_path):
+        revisions = [revision for revision, path, event_path in self.changes if path == calendar_path]
+        return str(max(revisions, default=0))
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests.clear()
+
+
+def multistatus(responses, sync_token=None):
+    ''' Build multistatus body from (href, props xml) tuples, props None means 404 '''
+    body = '<?xml version="1.0" encoding="utf-8"?><d:multistatus xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav" xmlns:cs="http://calendarserver.org/ns/">'
+    for href, props in responses:
+        if props is None:
+            body += f'<d:response><d:href>{escape(href)}</d:href><d:status>HTTP/1.1 404 Not Found</d:status></d:response>'
+        else:
+            body += f'<d:response><d:href>{escape(href)}</d:href><d:propstat><d:prop>{props}</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>'
+    if sync_token:
+        body += f'<d:sync-token>{escape(sync_token)}</d:sync-token>'
+    return body + '</d:multistatus>'
+
+
+def make_handler(caldav):
+    class Handler(fake_server.FakeRequestHandler):
+        default_content_type = 'application/xml; charset=utf-8'
+
+        def authorized(self):
+            expected = base64.b64encode(f'{caldav.user}:{caldav.password}'.encode('UTF-8')).decode('ascii')
+            return self.headers.get('Authorization') == f'Basic {expected}'
+
+        def handle_method(self, method):
+            body = self.read_body()
+            path = unquote(urlparse(self.path).path)
+            caldav.requests[method] += 1
+            if not self.authorized():
+                self.send_body(401, 'Unauthorized', 'text/plain', {'WWW-Authenticate': 'Basic realm="fake-caldav"'})
+                return
+            with caldav.lock:
+                getattr(self, f'handle_{method.lower()}')(path, body)
+
+        def calendar_props(self, calendar_path):
+            calendar = caldav.calendars[calendar_path]
+            return (f'<d:resourcetype><d:collection/><c:calendar/></d:resourcetype><d:displayname>{escape(calendar["name"])}</d:displayname>'
+                    f'<cs:getctag>{caldav.get_ctag(calendar_path)}</cs:getctag><d:sync-token>{SYNC_TOKEN_PREFIX}{caldav.revision}</d:sync-token>'
+                    '<c:supported-calendar-component-set><c:comp name="VEVENT"/></c:supported-calendar-component-set>')
+
+        def handle_propfind(self, path, body):
+            depth = self.headers.get('Depth', '0')
+            if path in caldav.calendars:
+                responses = [(path, self.calendar_props(path))]
+                if depth != '0':
+                    responses += [(event_path, f'<d:resourcetype/><d:getetag>{escape(event["etag"])}</d:getetag><d:getcontenttype>text/calendar</d:getcontenttype>')
+                                  for event_path, event in caldav.calendars[path]['events'].items()]
+            elif path == caldav.home_path:
+                responses = [(path, '<d:resourcetype><d:collection/></d:resourcetype>')]
+                if depth != '0':
+                    responses += [(calendar_path, self.calendar_props(calendar_path)) for calendar_path in caldav.calendars]
+            else:
+                # root and principal both answer discovery properties
+                responses = [(path, f'<d:resourcetype><d:collection/></d:resourcetype><d:current-user-principal><d:href>{caldav.principal_path}</d:href></d:current-user-principal>'
+                                    f'<c:calendar-home-set><d:href>{caldav.home_path}</d:href></c:calendar-home-set>')]
+            self.send_body(207, multistatus(responses))
+
+        def handle_report(self, path, body):
+            if path not in caldav.calendars:
+                self.send_body(404, 'Not found', 'text/plain')
+                return
+            events = caldav.calendars[path]['events']
+            root = ET.fromstring(body)
+            if root.tag == f'{DAV_NS}sync-collection':
+                if not caldav.sync_collection:
+                    self.send_body(501, 'sync-collection not supported', 'text/plain')
+                    return
+                sync_token = root.findtext(f'{DAV_NS}sync-token') or ''
+                if not sync_token:
+                    responses = [(event_path, f'<d:getetag>{escape(event["etag"])}</d:getetag>') for event_path, event in events.items()]
+                elif not sync_token.startswith(SYNC_TOKEN_PREFIX) or not sync_token[len(SYNC_TOKEN_PREFIX):].isdigit():
+                    self.send_body(403, '<?xml version="1.0" encoding="utf-8"?><d:error xmlns:d="DAV:"><d:valid-sync-token/></d:error>')
+                    return
+                else:
+                    since = int(sync_token[len(SYNC_TOKEN_PREFIX):])
+                    changed = dict.fromkeys(event_path for revision, calendar_path, event_path in caldav.changes if calendar_path == path and revision > since)
+                    responses = [(event_path, f'<d:getetag>{escape(events[event_path]["etag"])}</d:getetag>' if event_path in events else None) for event_path in changed]
+                self.send_body(207, multistatus(responses, f'{SYNC_TOKEN_PREFIX}{caldav.revision}'))
+            elif root.tag == f'{CALDAV_NS}calendar-multiget':
+                hrefs = [unquote(urlparse(href.text.strip()).path) for href in root.findall(f'{DAV_NS}href')]
+                self.send_body(207, multistatus([(href, f'<d:getetag>{escape(events[href]["etag"])}</d:getetag><c:calendar-data>{escape(events[href]["data"])}</c:calendar-data>'
+                                                  if href in events else None) for href in hrefs]))
+            elif root.tag == f'{CALDAV_NS}calendar-query':
+                # no time range filtering, the client filters anyway
+                self.send_body(207, multistatus([(event_path, f'<d:getetag>{escape(event["etag"])}</d:getetag><c:calendar-data>{escape(event["data"])}</c:calendar-data>')
+                                                 for event_path, event in events.items()]))
+            else:
+                self.send_body(400, 'Unsupported report', 'text/plain')
+
+        def handle_get(self, path, body):
+            for calendar in caldav.calendars.values():
+                if path in calendar['events']:
+                    event = calendar['events'][path]
+                    self.send_body(200, event['data'], 'text/calendar; charset=utf-8', {'ETag': event['etag']})
+                    return
+            self.send_body(404, 'Not found', 'text/plain')
+
+        def handle_put(self, path, body):
+            calendar_path, event_name = path.rsplit('/', 1)
+            calendar_path += '/'
+            if calendar_path not in caldav.calendars:
+                self.send_body(409, 'Calendar does not exist', 'text/plain')
+                return
+            caldav.put_event(caldav.calendars[calendar_path]['name'], body.decode('UTF-8'), event_name[:-len('.ics')] if event_name.endswith('.ics') else event_name)
+            self.send_body(201, '', 'text/plain')
+
+        def handle_delete(self, path, body):
+            self.send_body(204 if caldav.delete_event(path) else 404, '', 'text/plain')
+
+        def handle_options(self, path, body):
+            self.send_body(200, '', 'text/plain', {'DAV': '1, 2, 3, calendar-access', 'Allow': 'OPTIONS, GET, PUT, DELETE, PROPFIND, REPORT'})
+
+        def do_PROPFIND(self):
+            self.handle_method('PROPFIND')
+
+        def do_REPORT(self):
+            self.handle_method('REPORT')
+
+        def do_GET(self):
+            self.handle_method('GET')
+
+        def do_PUT(self):
+            self.handle_method('PUT')
+
+        def do_DELETE(self):
+            self.handle_method('DELETE')
+
+        def do_OPTIONS(self):
+            self.handle_method('OPTIONS')
+
+    return Handler
+
+
+class FakeCalDAVServer(fake_server.FakeServer):
+    ''' Runs the fake CalDAV server in a background thread, usable as context manager '''
+
+    def __init__(self, caldav, host='127.0.0.1', port=0):
+        super().__init__(make_handler(caldav), host, port)
+        self.caldav = caldav
+
+    @property
+    def url(self):
+        return f'{self.base_url}/'
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser(description='Run a fake CalDAV server for events_today.py')
+    parser.add_argument('-p', '--port', help='Port to listen on', type=int, default=5232)
+    parser.add_argument('-u', '--user', help='Accepted user name', default='user')
+    parser.add_argument('-pw', '--password', help='Accepted password', default='password')
+    parser.add_argument('-c', '--calendars', help='Calendars to create', nargs='*', default=['Personal'])
+    parser.add_argument('-e', '--event', help='Event to add as <calendar>:<path to .ics file>, can be given multiple times', action='append', default=[])
+    parser.add_argument('-ns', '--no-sync-collection', help='Answer sync-collection REPORTs with 501 to test the ctag fallback', action='store_true')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = setup_parser()
+    caldav = FakeCalDAV(args.user, args.password, sync_collection=not args.no_sync_collection)
+    for calendar_name in args.calendars:
+        caldav.add_calendar(calendar_name)
+    for event in args.event:
+        calendar_name, ics_file = event.split(':', 1)
+        with open(ics_file, 'r', encoding='UTF-8') as f:
+            caldav.put_event(calendar_name, f.read())
+    server = FakeCalDAVServer(caldav, port=args.port)
+    print(f'Serving fake CalDAV server at {server.url} for user "{args.user}"')
+    server.serve_forever(caldav.requests)
+
+
+if __name__ == '__main__':
+    main()
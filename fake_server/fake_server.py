@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Scaffolding shared by the fake API servers used to test and benchmark the tools in this repository offline
+# (cloudflare_update_record/fake_cloudflare_api.py, events_today/fake_caldav_server.py): a keep-alive request handler
+# base class and a threaded server that runs in the background or in the foreground from the command line.
+#
+# The fake servers import it from this folder:
+#   sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'fake_server'))
+#   import fake_server
+
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    ''' Keep-alive handler base, subclasses implement the do_<METHOD> methods '''
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, without this keep-alive clients wait for delayed ACKs
+    disable_nagle_algorithm = True
+    default_content_type = 'text/plain'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        # always consume the body, keep-alive connections break otherwise on early error responses
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send_body(self, status, body, content_type=None, headers=None):
+        payload = body.encode('UTF-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type or self.default_content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeServer:
+    ''' Runs a handler class in a threaded HTTP server in a background thread, usable as context manager '''
+
+    def __init__(self, handler_class, host='127.0.0.1', port=0):
+        self.httpd = ThreadingHTTPServer((host, port), handler_class)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def serve_forever(self, requests):
+        ''' Serve in the foreground until interrupted, then print the given request statistics '''
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            print('\nInterrupted by user. Exiting...')
+            print(f'Requests: {dict(requests)}')
+            self.httpd.server_close()
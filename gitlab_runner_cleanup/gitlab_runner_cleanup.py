@@ -3,10 +3,28 @@
 # pip3 install python-gitlab
 import argparse
 import gitlab
+import json
 import logging
+import os
+import requests
+import sys
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+
+# shared HTTP client from ../api_client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'api_client'))
+import api_client
 
 
 log_levels = {'crit': logging.CRITICAL, 'warn': logging.WARN, 'info': logging.INFO, 'debug': logging.DEBUG}
+# 'not_connected' is what older GitLab versions report for 'never_contacted'
+deletable_statuses = ['offline', 'never_contacted', 'not_connected', 'stale', 'any']
+runner_types = ['instance_type', 'group_type', 'project_type']
+# runner detail fields kept in the on-disk cache
+cached_detail_fields = ['contacted_at', 'tag_list', 'projects', 'groups']
+retryable_response_codes = [429, 500, 502, 503, 504]
 
 
 def setup_parser():
@@ -15,7 +33,23 @@ def setup_parser():
     parser.add_argument('-v', '--log-level', help=f'Log level, possible choices: {list(log_levels)}', default='info')
     parser.add_argument('-f', '--no-dry-run', help='Deactivate dry run and actually delete runners.', action='store_true')
     parser.add_argument('-t', '--token', help='GitLab API token', required=True)
+    parser.add_argument('-s', '--status', help=f'Runner statuses to filter for server-side, possible choices: {deletable_statuses}. "any" lists all runners and requires at least one of the other selectors.', nargs='+', choices=deletable_statuses, default=['offline', 'never_contacted'])
+    parser.add_argument('-ca', '--contacted-before-days', help='Only select runners which last contacted GitLab more than n days ago (or never)', type=int)
+    parser.add_argument('-tg', '--tag', help='Only select runners with all of the given tags', nargs='+', default=[])
+    parser.add_argument('-rt', '--runner-type', help=f'Only select runners of the given types, possible choices: {runner_types}', nargs='+', choices=runner_types, default=[])
+    parser.add_argument('-p', '--project', help='Only select runners assigned to one of the given projects (ID or path with namespace)', nargs='+', default=[])
+    parser.add_argument('-c', '--cache-file', help='Cache file for runner details', default='gitlab_runner_cleanup_cache.json')
+    parser.add_argument('-ct', '--cache-ttl', help='Hours after which cached runner details are fetched again', type=float, default=24)
+    parser.add_argument('-nc', '--no-cache', help='Neither read nor write the runner details cache', action='store_true')
+    parser.add_argument('-w', '--workers', help='Number of concurrent runner detail and delete requests', type=int, default=4)
+    parser.add_argument('-r', '--retries', help='Retries per runner for rate limited or failed delete requests', type=int, default=5)
+    parser.add_argument('-pp', '--per-page', help='Runners per page when listing', type=int, default=100)
+    parser.add_argument('-pi', '--progress-interval', help='Log progress every n processed runners', type=int, default=100)
+    api_client.add_arguments(parser)
     args = parser.parse_args()
+    # "any" on its own would select every runner, including online ones
+    if 'any' in args.status and args.contacted_before_days is None and not (args.tag or args.runner_type or args.project):
+        parser.error('status "any" requires at least one of --contacted-before-days, --tag, --runner-type or --project')
     return args
 
 def setup_logging(args):
@@ -27,50 +61,222 @@ def setup_logging(args):
         logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=log_levels[args.log_level])
         logging.debug(f'Set log level "{args.log_level}"')
 
-def gitlab_auth(args):
-    # private token or personal token authentication
-    gl = gitlab.Gitlab(args.host, private_token=args.token)
+def gitlab_auth(client, args):
+    # private token or personal token authentication, python-gitlab uses the pooled session of the shared client,
+    # which records metrics, and retries 429 responses itself honoring Retry-After
+    gl = gitlab.Gitlab(args.host, private_token=args.token, session=client.session, timeout=client.timeout)
     # make an API request to create the gl.user object. This is mandatory if you
     # use the username/password authentication.
     gl.auth()
     return gl
 
-def get_runners_to_delete(gl):
+def is_deletable(runner, args):
+    if 'any' in args.status:
+        return True
+    statuses = args.status + ['not_connected'] if 'never_contacted' in args.status else args.status
+    return runner.online != True and runner.status in statuses
+
+def get_runners_to_delete(gl, args):
+    ''' Yield deletable runners page by page, filtered server-side by status '''
     logging.info("Retrieving runners to delete...")
-    runners_to_delete = []
-    runners = gl.runners.list(all=True)
-    for runner in runners:
-        if (runner.online == None and runner.status == 'not_connected') or (runner.online == False and runner.status == 'offline'):
-            runners_to_delete.append(runner)
-    return runners_to_delete
+    seen_ids = set()
+    for status in ([None] if 'any' in args.status else args.status):
+        found_new = True
+        # deleting while paging shifts the offset based pages, so repeat listing until no new runners show up
+        while found_new:
+            found_new = False
+            logging.debug(f"Listing runners with status '{status or 'any'}'...")
+            list_filters = {'status': status} if status else {}
+            for runner in gl.runners.list(iterator=True, per_page=args.per_page, **list_filters):
+                # runners might show up for multiple statuses if their status changes while listing
+                if runner.id in seen_ids or not is_deletable(runner, args):
+                    continue
+                seen_ids.add(runner.id)
+                found_new = args.no_dry_run
+                yield runner
+
+def load_cache(args):
+    if args.no_cache:
+        return {}
+    try:
+        with open(args.cache_file, 'r', encoding='UTF-8') as f:
+            cache = json.load(f)
+        logging.debug(f"Loaded {len(cache)} cached runner details from '{args.cache_file}'")
+        return cache
+    except FileNotFoundError:
+        logging.debug(f"No runner details cache at '{args.cache_file}', starting with empty cache")
+        return {}
+    except ValueError:
+        logging.warning(f"Runner details cache '{args.cache_file}' is corrupt, ignoring it")
+        return {}
+
+def save_cache(cache, args):
+    if args.no_cache:
+        return
+    # expired entries would be fetched again anyway, dropping them keeps deleted runners from piling up
+    cache = {runner_id: cached for runner_id, cached in cache.items() if time.time() - cached['fetched_at'] < args.cache_ttl * 3600}
+    # write to temp file first so an interrupted run can't leave a truncated cache behind
+    with open(f'{args.cache_file}.tmp', 'w', encoding='UTF-8') as f:
+        json.dump(cache, f)
+    os.replace(f'{args.cache_file}.tmp', args.cache_file)
+    logging.debug(f"Saved {len(cache)} runner details to '{args.cache_file}'")
+
+def get_cache_key(runner):
+    ''' The runner API has no updated_at, so cached details are invalidated by a change of the listed state instead '''
+    return f"{runner.status}/{runner.online}/{getattr(runner, 'paused', getattr(runner, 'active', None))}"
+
+def get_runner_details(gl, runner, cache, args):
+    ''' Get detail fields of runner from cache or by requesting them from the API '''
+    cached = cache.get(str(runner.id))
+    if cached and cached['key'] == get_cache_key(runner) and time.time() - cached['fetched_at'] < args.cache_ttl * 3600:
+        return cached['details'], False
+    runner_details = gl.runners.get(runner.id)
+    details = {field: runner_details.attributes.get(field) for field in cached_detail_fields}
+    details['projects'] = [{'id': project['id'], 'path_with_namespace': project.get('path_with_namespace')} for project in details['projects'] or []]
+    details['groups'] = [{'id': group['id'], 'web_url': group.get('web_url')} for group in details['groups'] or []]
+    return details, True
+
+def parse_gitlab_time(time_str):
+    return datetime.fromisoformat(time_str.replace('Z', '+00:00'))
+
+def get_policy(args):
+    ''' Build list of selectors (name, needs details, predicate) a runner has to match all of to be deleted '''
+    policy = []
+    if args.runner_type:
+        policy.append(('runner type', False, lambda runner, details: runner.runner_type in args.runner_type))
+    if args.contacted_before_days is not None:
+        contacted_before = datetime.now(timezone.utc) - timedelta(days=args.contacted_before_days)
+        policy.append((f'contacted before {contacted_before:%Y-%m-%d %H:%M}', True,
+                       lambda runner, details: not details['contacted_at'] or parse_gitlab_time(details['contacted_at']) < contacted_before))
+    if args.tag:
+        policy.append((f'tags {args.tag}', True, lambda runner, details: set(args.tag) <= set(details['tag_list'] or [])))
+    if args.project:
+        policy.append((f'projects {args.project}', True,
+                       lambda runner, details: any(str(project['id']) in args.project or project['path_with_namespace'] in args.project for project in details['projects'])))
+    return policy
+
+def select_runners(gl, runners, policy, cache, args):
+    ''' Yield runners matching all selectors of the policy, fetching runner details concurrently in batches where needed '''
+    list_selectors = [selector for selector in policy if not selector[1]]
+    detail_selectors = [selector for selector in policy if selector[1]]
+    fetched_count = 0
+
+    def matches(runner, details, selectors):
+        for name, needs_details, predicate in selectors:
+            if not predicate(runner, details):
+                logging.debug(f"Runner with ID '{runner.id}' does not match selector '{name}'")
+                return False
+        return True
+
+    def fetch_details(runner):
+        try:
+            return get_runner_details(gl, runner, cache, args)
+        except gitlab.exceptions.GitlabGetError as e:
+            # e.g. 404 for runners deleted in the meantime or 403 for runners the token can't see
+            logging.warning(f"Skipping runner with ID '{runner.id}', getting its details failed with status {e.response_code}: {e.error_message}")
+            return None, False
+
+    def process_batch(executor, batch):
+        nonlocal fetched_count
+        for runner, (details, fetched) in zip(batch, executor.map(fetch_details, batch)):
+            if details is None:
+                continue
+            if fetched:
+                fetched_count += 1
+                cache[str(runner.id)] = {'key': get_cache_key(runner), 'fetched_at': time.time(), 'details': details}
+            if matches(runner, details, detail_selectors):
+                yield runner
+
+    with api_client.BoundedExecutor(args.workers) as executor:
+        batch = []
+        for runner in runners:
+            if not matches(runner, None, list_selectors):
+                continue
+            if not detail_selectors:
+                yield runner
+                continue
+            batch.append(runner)
+            if len(batch) >= args.per_page:
+                yield from process_batch(executor, batch)
+                batch = []
+        yield from process_batch(executor, batch)
+    if detail_selectors:
+        logging.info(f"Fetched details of {fetched_count} runners from the API, the rest came from the cache.")
+
+def delete_runner(runner_to_delete, args):
+    ''' Delete runner, retrying with exponential backoff on rate limits and server errors '''
+    for attempt in range(args.retries + 1):
+        try:
+            runner_to_delete.delete()
+            return True
+        except gitlab.exceptions.GitlabDeleteError as e:
+            if e.response_code == 404:
+                logging.debug(f"Runner with ID '{runner_to_delete.id}' is already gone.")
+                return True
+            if e.response_code not in retryable_response_codes or attempt == args.retries:
+                logging.error(f"An error occurred trying to delete runner with ID: '{runner_to_delete.id}'.\nException:\n{e}")
+                return False
+            backoff = api_client.get_backoff(attempt)
+            logging.warning(f"Deleting runner with ID '{runner_to_delete.id}' failed with status {e.response_code}, retrying in {backoff:.1f}s...")
+            time.sleep(backoff)
 
 def remove_runners(runners_to_delete, args):
     removed_count = 0
-    for runner_to_delete in runners_to_delete:
-        logging.info(f"Deleting runner... ID: '{runner_to_delete.id}' Name: '{runner_to_delete.description}'")
-        if args.no_dry_run:
-            try:
-                runner_to_delete.delete()
-            except gitlab.exceptions.GitlabDeleteError as e:
-                logging.error(f"An error occurred trying to delete runner with ID: '{runner_to_delete.id}'.\nException:\n{e}")
-        else:
-            logging.info("DRY RUN! Not actually deleting runner.")
-        logging.info("")
-        removed_count += 1
-    return removed_count
+    failed_count = 0
+    start = time.monotonic()
+    lock = threading.Lock()
+
+    def log_progress():
+        if removed_count % args.progress_interval == 0:
+            logging.info(f"Progress: {removed_count} runners processed, {failed_count} failed, {removed_count / (time.monotonic() - start):.1f} runners/s")
+
+    def on_done(future, runner_to_delete):
+        nonlocal removed_count, failed_count
+        try:
+            deleted = future.result()
+        except (gitlab.exceptions.GitlabError, requests.RequestException) as e:
+            logging.error(f"An error occurred trying to delete runner with ID: '{runner_to_delete.id}'.\nException:\n{e}")
+            deleted = False
+        with lock:
+            removed_count += 1
+            if not deleted:
+                failed_count += 1
+            log_progress()
+
+    # bounds the number of queued deletions so pages are only fetched as fast as we delete
+    with api_client.BoundedExecutor(args.workers) as executor:
+        for runner_to_delete in runners_to_delete:
+            logging.info(f"Deleting runner... ID: '{runner_to_delete.id}' Name: '{runner_to_delete.description}'")
+            if args.no_dry_run:
+                executor.submit(delete_runner, runner_to_delete, args, callback=lambda future, runner_to_delete=runner_to_delete: on_done(future, runner_to_delete))
+            else:
+                logging.info("DRY RUN! Not actually deleting runner.")
+                with lock:
+                    removed_count += 1
+                    log_progress()
+    if failed_count:
+        logging.error(f"Failed to delete {failed_count} runners.")
+    return removed_count - failed_count
 
 def main():
     args = setup_parser()
     setup_logging(args)
-    gl = gitlab_auth(args)
-    runners_to_delete = get_runners_to_delete(gl)
-    removed_count = remove_runners(runners_to_delete, args)
+    client = api_client.ApiClient(timeout=args.timeout, connect_timeout=args.connect_timeout, pool_size=args.workers)
+    gl = gitlab_auth(client, args)
+    policy = get_policy(args)
+    cache = load_cache(args)
+    runners_to_delete = select_runners(gl, get_runners_to_delete(gl, args), policy, cache, args)
+    try:
+        removed_count = remove_runners(runners_to_delete, args)
+    finally:
+        save_cache(cache, args)
+        client.report(args, 'gitlab_runner_cleanup')
     if removed_count >= 1:
         logging.info(f"Deleted {removed_count} runners!")
         if not args.no_dry_run:
             logging.info("DRY RUN! No runners were actually deleted. Give parameter --no-dry-run to actually delete runners.")
     else:
-        logging.info("Found no runners with status 'not_connected' or 'offline' to delete.")
+        logging.info(f"Found no runners with status {args.status} matching {[name for name, needs_details, predicate in policy] or 'no further selectors'} to delete.")
 
 
 if __name__ == "__main__":
@@ -5,13 +5,25 @@ import json
 import sys
 
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+
+# numpy is only needed for --reconstruct: pip3 install numpy
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+EARTH_RADIUS_M = 6371008.8
+SECONDS_PER_DAY = 86400
 
 
 def parse_args():
-    p = argparse.ArgumentParser(description="Find days with > threshold km travelled by car in Google Timeline JSON export file. Each activity's full distanceMeters is attributed to the calendar day of its startTime")
+    p = argparse.ArgumentParser(description="Find days with > threshold km travelled by car in Google Timeline JSON export file. Each activity's full distanceMeters is attributed to the calendar day of its startTime, unless --reconstruct is used")
     p.add_argument("--file", "-f", required=True, help="Path to Timeline.json")
     p.add_argument("--threshold", "-t", type=float, default=100.0, help="Threshold in km")
+    p.add_argument("--reconstruct", "-r", action="store_true", help="Reconstruct distances of vehicle activities from timelinePath and raw path points, split trips at midnight (needs numpy)")
+    p.add_argument("--max-speed", "-s", type=float, default=250.0, help="With --reconstruct, drop point to point jumps faster than this in km/h")
     return p.parse_args()
 
 
@@ -23,6 +35,20 @@ def is_vehicle_type(candidate_type: str) -> bool:
     return any(k in t for k in keywords)
 
 
+def get_activity_type(act) -> str:
+    # find candidate type
+    cand = None
+    if isinstance(act.get("topCandidate"), dict):
+        cand = act.get("topCandidate").get("type")
+    # sometimes nested differently
+    if not cand and isinstance(act.get("topCandidate"), str):
+        cand = act.get("topCandidate")
+    # older Takeout exports (activitySegment) use activityType
+    if not cand and isinstance(act.get("activityType"), str):
+        cand = act.get("activityType")
+    return cand or ""
+
+
 def get_entries(data):
     # Support multiple possible top-level array keys used by Google exports
     if isinstance(data, dict):
@@ -96,15 +122,7 @@ def analyze(entries, threshold_km) -> list[tuple[str, float]]:
                 # nothing to sum
                 continue
 
-            # find candidate type
-            cand = None
-            if isinstance(act.get("topCandidate"), dict):
-                cand = act.get("topCandidate").get("type")
-            # sometimes nested differently
-            if not cand and isinstance(act.get("topCandidate"), str):
-                cand = act.get("topCandidate")
-
-            if not is_vehicle_type(cand or ""):
+            if not is_vehicle_type(get_activity_type(act)):
                 continue
 
             # attribute to day of startTime
@@ -133,17 +151,238 @@ def analyze(entries, threshold_km) -> list[tuple[str, float]]:
     return out
 
 
+def parse_time(time_str: str) -> tuple[float, float]:
+    # returns unix time and UTC offset in seconds, naive timestamps are taken as UTC
+    dt = datetime.fromisoformat(time_str.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp(), dt.utcoffset().total_seconds()
+
+
+def parse_lat_lng(point) -> tuple[float, float] | None:
+    # newer exports: "48.1372°, 11.5756°" or "geo:48.1372,11.5756", older ones: latE7/lngE7 or latitudeE7/longitudeE7
+    if isinstance(point, str):
+        try:
+            lat, lng = point.replace("geo:", "").replace("°", "").split(",")
+            return float(lat), float(lng)
+        except ValueError:
+            return None
+    if isinstance(point, dict):
+        lat = point.get("latE7", point.get("latitudeE7"))
+        lng = point.get("lngE7", point.get("longitudeE7"))
+        if lat is not None and lng is not None:
+            return lat / 1e7, lng / 1e7
+        if "latLng" in point:
+            return parse_lat_lng(point["latLng"])
+    return None
+
+
+def get_entry_points(e, act) -> list[tuple[str, object]]:
+    # (timestamp, location) pairs of a timeline entry, act is its activity if any
+    start = e.get("startTime") or (act or {}).get("duration", {}).get("startTimestamp")
+    end = e.get("endTime") or (act or {}).get("duration", {}).get("endTimestamp")
+    points = []
+    for p in e.get("timelinePath") or []:
+        if p.get("time"):
+            points.append((p["time"], p.get("point")))
+        elif start and p.get("durationMinutesOffsetFromStartTime") is not None:
+            t = datetime.fromisoformat(start.replace("Z", "+00:00")) + timedelta(minutes=float(p["durationMinutesOffsetFromStartTime"]))
+            points.append((t.isoformat(), p.get("point")))
+    if isinstance(act, dict):
+        for p in (act.get("simplifiedRawPath") or {}).get("points") or []:
+            if p.get("timestamp"):
+                points.append((p["timestamp"], p))
+        if start:
+            points.append((start, act.get("start") or act.get("startLocation")))
+        if end:
+            points.append((end, act.get("end") or act.get("endLocation")))
+    return points
+
+
+def get_vehicle_activities(entries) -> list[dict]:
+    # vehicle activities with start/end unix time, UTC offset of the start and reported distance (None if missing)
+    activities = []
+    for e in entries:
+        act = e.get("activity") or e.get("activitySegment")
+        if not isinstance(act, dict) or not is_vehicle_type(get_activity_type(act)):
+            continue
+        start = e.get("startTime") or act.get("duration", {}).get("startTimestamp")
+        end = e.get("endTime") or act.get("duration", {}).get("endTimestamp")
+        if not start or not end:
+            continue
+        try:
+            start_t, offset = parse_time(start)
+            end_t, _ = parse_time(end)
+        except ValueError:
+            continue
+        dist = act.get("distanceMeters", act.get("distance"))
+        try:
+            dist = float(dist) if dist is not None else None
+        except (TypeError, ValueError):
+            dist = None
+        activities.append({"start": start_t, "end": end_t, "offset": offset, "distance": dist})
+    activities.sort(key=lambda a: a["start"])
+    return activities
+
+
+def parse_times(time_strs: list[str]):
+    # vectorized parse_time for ISO timestamps with "Z" or "+HH:MM" suffix: numpy parses the local part in one go
+    cores, offsets, suffix_offsets = [], [], {}
+    for time_str in time_strs:
+        if time_str.endswith("Z"):
+            cores.append(time_str[:-1])
+            offsets.append(0.0)
+        elif len(time_str) > 6 and time_str[-6] in "+-" and time_str[-3] == ":":
+            suffix = time_str[-6:]
+            if suffix not in suffix_offsets:
+                suffix_offsets[suffix] = (1 if suffix[0] == "+" else -1) * (int(suffix[1:3]) * 3600 + int(suffix[4:6]) * 60)
+            cores.append(time_str[:-6])
+            offsets.append(suffix_offsets[suffix])
+        else:
+            cores.append(time_str)
+            offsets.append(0.0)
+    offsets = np.asarray(offsets, dtype=np.float64)
+    local = np.asarray(cores, dtype="datetime64[ms]").astype(np.int64) / 1000.0
+    return local - offsets, offsets
+
+
+def get_point_arrays(entries):
+    # all timestamped points of the export as numpy arrays sorted by time: unix time, UTC offset, lat, lng
+    time_strs, coords = [], []
+    for e in entries:
+        act = e.get("activity") or e.get("activitySegment")
+        for time_str, point in get_entry_points(e, act if isinstance(act, dict) else None):
+            if not isinstance(time_str, str):
+                continue
+            # "lat°, lng°" strings are parsed by numpy in one go below, everything else is normalized to that
+            if not isinstance(point, str) or point.count(",") != 1:
+                lat_lng = parse_lat_lng(point)
+                if lat_lng is None:
+                    continue
+                point = f"{lat_lng[0]},{lat_lng[1]}"
+            time_strs.append(time_str)
+            coords.append(point)
+    times, offsets = parse_times(time_strs)
+    lat_lngs = np.asarray(",".join(coords).replace("geo:", "").replace("°", "").split(",") if coords else [], dtype=np.float64).reshape(-1, 2)
+    lats, lngs = lat_lngs[:, 0], lat_lngs[:, 1]
+    order = np.argsort(times, kind="stable")
+    return times[order], offsets[order], lats[order], lngs[order]
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = (np.radians(a) for a in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def split_by_day(start: float, end: float, offset: float, weight: float) -> dict:
+    # distribute weight over the local calendar days of [start, end] proportionally to time
+    if end <= start:
+        return {int((start + offset) // SECONDS_PER_DAY): weight}
+    out = {}
+    t = start
+    while t < end:
+        day = int((t + offset) // SECONDS_PER_DAY)
+        day_end = min((day + 1) * SECONDS_PER_DAY - offset, end)
+        out[day] = out.get(day, 0.0) + weight * (day_end - t) / (end - start)
+        t = day_end
+    return out
+
+
+def analyze_reconstructed(entries, threshold_km, max_speed_kmh) -> tuple[list[tuple[str, float]], dict]:
+    activities = get_vehicle_activities(entries)
+    stats = {"activities": len(activities), "reported": 0, "reconstructed": 0, "missing": 0, "dropped_jumps": 0}
+    if not activities:
+        return [], stats
+    times, offsets, lats, lngs = get_point_arrays(entries)
+
+    # distance, duration and speed of all consecutive point pairs at once
+    dist = haversine_m(lats[:-1], lngs[:-1], lats[1:], lngs[1:])
+    dt = np.diff(times)
+    plausible = (dt > 0) & (dist <= np.maximum(dt, 1.0) * max_speed_kmh / 3.6)
+    stats["dropped_jumps"] = int(np.count_nonzero((dt > 0) & ~plausible))
+
+    # assign each pair to the vehicle activity containing its midpoint
+    starts = np.array([a["start"] for a in activities], dtype=np.float64)
+    ends = np.array([a["end"] for a in activities], dtype=np.float64)
+    mid = (times[:-1] + times[1:]) / 2
+    act_idx = np.searchsorted(starts, mid, side="right") - 1
+    inside = plausible & (act_idx >= 0) & (mid <= ends[np.clip(act_idx, 0, None)])
+
+    seg = np.flatnonzero(inside)
+    seg_start, seg_end, seg_offset = times[seg], times[seg + 1], offsets[seg]
+    start_day = np.floor_divide(seg_start + seg_offset, SECONDS_PER_DAY).astype(np.int64)
+    end_day = np.floor_divide(seg_end + seg_offset, SECONDS_PER_DAY).astype(np.int64)
+
+    # same-day pairs are summed per (activity, day) in one go, the few midnight-crossing ones are split by time
+    per_act_day = defaultdict(float)
+    same = start_day == end_day
+    if np.any(same):
+        first_day = int(start_day[same].min())
+        day_count = int(start_day[same].max()) - first_day + 1
+        keys = act_idx[seg][same] * day_count + (start_day[same] - first_day)
+        unique, inverse = np.unique(keys, return_inverse=True)
+        sums = np.bincount(inverse.ravel(), weights=dist[seg][same])
+        for key, meters in zip(unique.tolist(), sums.tolist()):
+            per_act_day[(key // day_count, key % day_count + first_day)] += meters
+    for i in np.flatnonzero(~same).tolist():
+        a = int(act_idx[seg[i]])
+        for day, meters in split_by_day(seg_start[i], seg_end[i], seg_offset[i], float(dist[seg[i]])).items():
+            per_act_day[(a, day)] += meters
+
+    reconstructed = defaultdict(dict)
+    for (a, day), meters in per_act_day.items():
+        reconstructed[a][day] = meters
+
+    per_day_meters = defaultdict(float)
+    for a, act in enumerate(activities):
+        days = reconstructed.get(a, {})
+        total = sum(days.values())
+        if act["distance"] is not None:
+            # reported distance follows roads, points are often sparse, so only use them to split it over days
+            stats["reported"] += 1
+            if total > 0:
+                days = {day: act["distance"] * meters / total for day, meters in days.items()}
+            else:
+                days = split_by_day(act["start"], act["end"], act["offset"], act["distance"])
+        elif total > 0:
+            stats["reconstructed"] += 1
+        else:
+            stats["missing"] += 1
+        for day, meters in days.items():
+            per_day_meters[day] += meters
+
+    out = []
+    for day, meters in sorted(per_day_meters.items()):
+        km = meters / 1000.0
+        if km > threshold_km:
+            out.append((datetime.fromtimestamp(day * SECONDS_PER_DAY, timezone.utc).date().isoformat(), round(km, 3)))
+
+    return out, stats
+
+
 def main():
     args = parse_args()
     try:
         with open(args.file, "r", encoding="utf-8") as f:
             data = json.load(f)
         entries = get_entries(data)
-        results = analyze(entries, args.threshold)
+        if args.reconstruct:
+            if np is None:
+                print("--reconstruct needs numpy, install it with: pip3 install numpy", file=sys.stderr)
+                sys.exit(2)
+            results, stats = analyze_reconstructed(entries, args.threshold, args.max_speed)
+        else:
+            results = analyze(entries, args.threshold)
     except Exception as exc:
         print(f"Error processing file: {exc}", file=sys.stderr)
         sys.exit(2)
 
+    if args.reconstruct:
+        print(f"{stats['activities']} vehicle activities: {stats['reported']} with reported distance, "
+              f"{stats['reconstructed']} reconstructed from points, {stats['missing']} without distance or points "
+              f"({stats['dropped_jumps']} implausible jumps dropped)")
+
     if not results:
         print(f"No days with > {args.threshold} km found.")
         return
@@ -2,10 +2,21 @@
 
 import argparse
 import gnupg # python3-gnupg
+import json
 import logging
+import os
+import signal
+import smtplib
+import sys
+import threading
+import time
+import uuid
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.base import MIMEBase
 from email.message import Message
+from queue import Queue
 from smtplib import SMTP_SSL as SMTP
 
 
@@ -14,16 +25,34 @@ from smtplib import SMTP_SSL as SMTP
 
 def setup_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-f', '--from-address', help='From email address', type=str, required=True)
-    parser.add_argument('-t', '--to-address', help='To email address', type=str, required=True)
-    parser.add_argument('-s', '--subject', help='Mail subject', type=str, required=True)
-    parser.add_argument('-u', '--url', help='SMTP server url', type=str, required=True)
-    parser.add_argument('-g', '--gpg-home', help='GPG home dir', type=str, required=True)
-    parser.add_argument('-p', '--password', help='SMTP password for user with from email address', type=str, required=True)
-    parser.add_argument('-m', '--message', help='Message to send', type=str, required=True)
+    parser.add_argument('-f', '--from-address', help='From email address, required unless enqueuing', type=str)
+    parser.add_argument('-t', '--to-address', help='To email address, required without --batch and --daemon', type=str)
+    parser.add_argument('-s', '--subject', help='Mail subject, required without --batch and --daemon', type=str)
+    parser.add_argument('-u', '--url', help='SMTP server url, required unless enqueuing', type=str)
+    parser.add_argument('-g', '--gpg-home', help='GPG home dir, required unless enqueuing', type=str)
+    parser.add_argument('-p', '--password', help='SMTP password for user with from email address, required unless enqueuing', type=str)
+    parser.add_argument('-m', '--message', help='Message to send, required without --batch and --daemon', type=str)
+    parser.add_argument('-b', '--batch', help='JSON lines file with one {"to": ..., "subject": ..., "message": ...} object per message to send, "-" for stdin', type=str)
+    parser.add_argument('-w', '--workers', help='Number of messages to encrypt concurrently in batch and daemon mode', type=int, default=4)
+    parser.add_argument('-c', '--smtp-connections', help='Number of SMTP connections to send over in batch mode', type=int, default=1)
+    parser.add_argument('-r', '--retries', help='Reconnects and retries per message if sending fails in batch mode, with exponential backoff between them', type=int, default=3)
+    parser.add_argument('-q', '--spool-dir', help='Spool directory for --enqueue and --daemon', type=str, default='mail_dat_spool')
+    parser.add_argument('-e', '--enqueue', help='Only drop message into spool directory for the daemon to send', action='store_true')
+    parser.add_argument('-d', '--daemon', help='Watch spool directory and send queued messages in the background', action='store_true')
+    parser.add_argument('-pi', '--poll-interval', help='Seconds between spool directory scans in daemon mode', type=float, default=1)
+    parser.add_argument('-ma', '--max-attempts', help='Delivery attempts per queued message before it is moved to the dead letter folder', type=int, default=8)
+    parser.add_argument('-rb', '--retry-backoff', help='Seconds to wait before the first retry of a queued message, doubled on every further attempt', type=float, default=30)
+    parser.add_argument('-mb', '--max-retry-backoff', help='Maximum seconds to wait between retries of a queued message', type=float, default=3600)
+    parser.add_argument('-it', '--smtp-idle-timeout', help='Seconds after which an idle SMTP connection is closed in daemon mode', type=float, default=60)
     parser.add_argument('-l', '--log-file', help='Log file to use', type=str, required=False, default='mail_dat.log')
     parser.add_argument('-sd', '--smtp-debug', help='Activate debug mode for SMTP connection', action='store_true', required=False, default=False)
     args = parser.parse_args()
+    if args.enqueue and (args.batch or args.daemon):
+        parser.error('--enqueue spools a single message given by --to-address, --subject and --message, it can not be combined with --batch or --daemon')
+    if not args.batch and not args.daemon and not (args.to_address and args.subject and args.message):
+        parser.error('--to-address, --subject and --message are required without --batch and --daemon')
+    if not args.enqueue and not (args.from_address and args.url and args.gpg_home and args.password):
+        parser.error('--from-address, --url, --gpg-home and --password are required unless enqueuing')
     return args
 
 
@@ -31,22 +60,25 @@ def setup_logging(args):
     logging.basicConfig(filename=args.log_file, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
 
 
-def get_gpg_cipher_text(string_to_encrypt, args):
-    logging.info(f'Encrypting message using key "{args.to_address}" from gpghome "{args.gpg_home}"...')
-    gpg = gnupg.GPG(gnupghome=args.gpg_home)
-    encrypted = gpg.encrypt(string_to_encrypt, args.to_address)
+def get_gpg(args):
+    return gnupg.GPG(gnupghome=args.gpg_home)
+
+
+def get_gpg_cipher_text(string_to_encrypt, to_address, gpg, args):
+    logging.info(f'Encrypting message using key "{to_address}" from gpghome "{args.gpg_home}"...')
+    encrypted = gpg.encrypt(string_to_encrypt, to_address)
     if encrypted.status != "encryption ok":
         logging.critical(f'ERROR while encrypting message\n{encrypted.stderr}')
-    else:
-        logging.info('Message encrypted successfully!')
+        return None
+    logging.info('Message encrypted successfully!')
     return str(encrypted)
 
 
-def get_email_string(args):
+def get_email_string(from_address, to_address, subject, message, gpg, args):
     msg = Message()
     msg.add_header(_name="Content-Type", _value="multipart/mixed", protected_headers="v1")
-    msg["From"] = args.from_address
-    msg["To"] = args.to_address
+    msg["From"] = from_address
+    msg["To"] = to_address
 
     msg_text = Message()
     msg_text.add_header(_name="Content-Type", _value="multipart/mixed")
@@ -55,15 +87,19 @@ def get_email_string(args):
     msg_body = Message()
     msg_body.add_header(_name="Content-Type", _value="text/plain", charset="utf-8")
     msg_body.add_header(_name="Content-Transfer-Encoding", _value="quoted-printable")
-    msg_body.set_payload(args.message + 2*"\n")
+    msg_body.set_payload(message + 2*"\n")
 
     msg_text.attach(msg_body)
     msg.attach(msg_text)
 
+    cipher_text = get_gpg_cipher_text(msg.as_string(), to_address, gpg, args)
+    if cipher_text is None:
+        return None
+
     pgp_msg = MIMEBase(_maintype="multipart", _subtype="encrypted", protocol="application/pgp-encrypted")
-    pgp_msg["From"] = args.from_address
-    pgp_msg["To"] = args.to_address
-    pgp_msg["Subject"] = args.subject
+    pgp_msg["From"] = from_address
+    pgp_msg["To"] = to_address
+    pgp_msg["Subject"] = subject
 
     pgp_msg_part1 = Message()
     pgp_msg_part1.add_header(_name="Content-Type", _value="application/pgp-encrypted")
@@ -74,7 +110,7 @@ def get_email_string(args):
     pgp_msg_part2.add_header(_name="Content-Type", _value="application/octet-stream", name="encrypted.asc")
     pgp_msg_part2.add_header(_name="Content-Description", _value="OpenPGP encrypted message")
     pgp_msg_part2.add_header(_name="Content-Disposition", _value="inline", filename="encrypted.asc")
-    pgp_msg_part2.set_payload(get_gpg_cipher_text(msg.as_string(), args))
+    pgp_msg_part2.set_payload(cipher_text)
 
     pgp_msg.attach(pgp_msg_part1)
     pgp_msg.attach(pgp_msg_part2)
@@ -82,10 +118,7 @@ def get_email_string(args):
     return pgp_msg.as_string()
 
 
-def send_mail(args):
-    logging.info('Generating email...')
-    enc_msg = get_email_string(args)
-
+def get_smtp_connection(args):
     logging.info(f'Opening SMTP connection to "{args.url}"')
     conn = SMTP(args.url)
     logging.info(f'SMTP debugging set to "{args.smtp_debug}"')
@@ -93,17 +126,305 @@ def send_mail(args):
 
     logging.info(f'SMTP login with "{args.from_address}"')
     conn.login(args.from_address, args.password)
+    return conn
+
+
+def close_smtp_connection(conn):
+    logging.info('Closing SMTP connection...')
+    try:
+        conn.quit()
+    except (smtplib.SMTPException, OSError):
+        conn.close()
+
 
+def send_mail(args):
+    logging.info('Generating email...')
+    enc_msg = get_email_string(args.from_address, args.to_address, args.subject, args.message, get_gpg(args), args)
+    if enc_msg is None:
+        logging.critical('Not sending unencrypted email. Exiting...')
+        sys.exit(1)
+
+    conn = get_smtp_connection(args)
     logging.info(f'Sending email from "{args.from_address}" to "{args.to_address}"')
     conn.sendmail(args.from_address, args.to_address, enc_msg)
-    logging.info('Closing SMTP connection...')
-    conn.quit()
+    close_smtp_connection(conn)
+
+
+def read_batch(batch_file):
+    ''' Yield (to address, subject, message) of every line in JSON lines batch file '''
+    f = sys.stdin if batch_file == '-' else open(batch_file, 'r', encoding='UTF-8')
+    try:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                yield entry['to'], entry['subject'], entry['message']
+            except (ValueError, KeyError, TypeError) as e:
+                logging.error(f'Skipping invalid line {line_number} of batch file "{batch_file}": {e}')
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def send_queued_mails(mail_queue, counts, lock, auth_failed, args):
+    ''' Send mails from queue over one persistent SMTP connection, reconnecting with backoff on failure '''
+    conn = None
+    while True:
+        item = mail_queue.get()
+        if item is None:
+            break
+        to_address, enc_msg = item
+        if auth_failed.is_set():
+            # keep draining the queue so the encrypting thread doesn't block on it
+            with lock:
+                counts['failed'] += 1
+            continue
+        for attempt in range(args.retries + 1):
+            if attempt:
+                time.sleep(min(2 ** (attempt - 1), 60))
+            try:
+                if conn is None:
+                    conn = get_smtp_connection(args)
+                logging.info(f'Sending email from "{args.from_address}" to "{to_address}"')
+                conn.sendmail(args.from_address, to_address, enc_msg)
+                with lock:
+                    counts['sent'] += 1
+                break
+            except smtplib.SMTPRecipientsRefused as e:
+                # permanent for this message, the connection is still fine
+                logging.error(f'Recipient "{to_address}" was refused: {e}')
+                with lock:
+                    counts['failed'] += 1
+                break
+            except smtplib.SMTPAuthenticationError as e:
+                # retrying or sending further mails would only hammer the login
+                logging.critical(f'SMTP login with "{args.from_address}" failed, not sending any further emails: {e}')
+                auth_failed.set()
+                with lock:
+                    counts['failed'] += 1
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                logging.warning(f'Sending email to "{to_address}" failed (attempt {attempt + 1}/{args.retries + 1}), reconnecting: {e}')
+                if conn is not None:
+                    conn.close()
+                    conn = None
+        else:
+            logging.error(f'Giving up sending email to "{to_address}"')
+            with lock:
+                counts['failed'] += 1
+    if conn is not None:
+        close_smtp_connection(conn)
+
+
+def send_batch(args):
+    ''' Encrypt batch messages in a worker pool sharing one GPG context and send them over persistent SMTP connections '''
+    gpg = get_gpg(args)
+    counts = {'sent': 0, 'failed': 0}
+    lock = threading.Lock()
+    auth_failed = threading.Event()
+    # bounded, so encryption doesn't run arbitrarily far ahead of sending
+    mail_queue = Queue(maxsize=args.workers * 4)
+    senders = [threading.Thread(target=send_queued_mails, args=(mail_queue, counts, lock, auth_failed, args)) for _ in range(args.smtp_connections)]
+    for sender in senders:
+        sender.start()
+
+    def encrypt(mail):
+        to_address, subject, message = mail
+        return to_address, get_email_string(args.from_address, to_address, subject, message, gpg, args)
+
+    def queue_mail(future):
+        to_address, enc_msg = future.result()
+        if enc_msg is None:
+            logging.error(f'Not sending unencrypted email to "{to_address}"')
+            with lock:
+                counts['failed'] += 1
+            return
+        mail_queue.put((to_address, enc_msg))
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            # window of pending encryptions, only read further messages once the oldest one was handed to the senders
+            pending = deque()
+            for mail in read_batch(args.batch):
+                if auth_failed.is_set():
+                    logging.critical('Stopping batch, SMTP login failed')
+                    break
+                pending.append(executor.submit(encrypt, mail))
+                if len(pending) >= args.workers * 2:
+                    queue_mail(pending.popleft())
+            while pending:
+                queue_mail(pending.popleft())
+    finally:
+        for sender in senders:
+            mail_queue.put(None)
+        for sender in senders:
+            sender.join()
+    logging.info(f'Batch done: {counts["sent"]} emails sent, {counts["failed"]} failed')
+    if counts['failed']:
+        sys.exit(1)
+
+
+def get_spool_dirs(args):
+    ''' Producers write to tmp and rename into new, failed messages end up in dead '''
+    spool_dirs = {name: os.path.join(args.spool_dir, name) for name in ('tmp', 'new', 'dead')}
+    for spool_dir in spool_dirs.values():
+        os.makedirs(spool_dir, exist_ok=True)
+    return spool_dirs
+
+
+def write_spool_file(spool_dirs, target_dir, name, entry):
+    ''' Write entry to tmp first and rename it into target directory, so the daemon never sees partial files '''
+    tmp_path = os.path.join(spool_dirs['tmp'], name)
+    with open(tmp_path, 'w', encoding='UTF-8') as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, os.path.join(target_dir, name))
+
+
+def enqueue_mail(args):
+    spool_dirs = get_spool_dirs(args)
+    # time prefix keeps delivery roughly in enqueue order
+    name = f'{time.time_ns()}_{os.getpid()}_{uuid.uuid4().hex[:8]}.json'
+    write_spool_file(spool_dirs, spool_dirs['new'], name, {'to': args.to_address, 'subject': args.subject, 'message': args.message, 'attempts': 0, 'next_attempt': 0})
+    logging.info(f'Enqueued email to "{args.to_address}" as "{name}"')
+
+
+def get_due_spool_files(spool_dirs, deferred, limit):
+    ''' Return up to limit (name, entry) of queued messages due for delivery, remembering deferred ones to not re-read them every scan '''
+    due = []
+    now = time.time()
+    names = sorted(name for name in os.listdir(spool_dirs['new']) if name.endswith('.json'))
+    for name in list(deferred):
+        if name not in names:
+            del deferred[name]
+    for name in names:
+        if deferred.get(name, 0) > now:
+            continue
+        try:
+            with open(os.path.join(spool_dirs['new'], name), 'r', encoding='UTF-8') as f:
+                entry = json.load(f)
+            missing_keys = {'to', 'subject', 'message'} - set(entry)
+            if missing_keys:
+                raise KeyError(f'missing keys {missing_keys}')
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f'Moving invalid spool file "{name}" to dead letter folder: {e}')
+            os.replace(os.path.join(spool_dirs['new'], name), os.path.join(spool_dirs['dead'], name))
+            continue
+        except FileNotFoundError:
+            continue
+        if entry.get('next_attempt', 0) > now:
+            deferred[name] = entry['next_attempt']
+            continue
+        due.append((name, entry))
+        if len(due) >= limit:
+            break
+    return due
+
+
+def defer_spool_file(spool_dirs, deferred, name, entry, error, args):
+    ''' Schedule next delivery attempt with exponential backoff or move message to dead letter folder '''
+    entry['attempts'] = entry.get('attempts', 0) + 1
+    entry['last_error'] = error
+    backoff = min(args.retry_backoff * 2 ** (entry['attempts'] - 1), args.max_retry_backoff)
+    # skipped in this process in any case, so a spool file that can't be updated isn't retried in a tight loop
+    deferred[name] = time.time() + backoff
+    try:
+        if entry['attempts'] >= args.max_attempts:
+            logging.error(f'Giving up on "{name}" to "{entry["to"]}" after {entry["attempts"]} attempts, moving it to dead letter folder: {error}')
+            write_spool_file(spool_dirs, spool_dirs['dead'], name, entry)
+            os.remove(os.path.join(spool_dirs['new'], name))
+            return
+        entry['next_attempt'] = deferred[name]
+        write_spool_file(spool_dirs, spool_dirs['new'], name, entry)
+    except OSError as e:
+        logging.error(f'Could not update spool file "{name}" after failed delivery: {e}')
+        return
+    logging.warning(f'Delivery of "{name}" to "{entry["to"]}" failed (attempt {entry["attempts"]}/{args.max_attempts}), retrying in {backoff}s: {error}')
+
+
+def remove_sent_spool_file(spool_dirs, deferred, name):
+    ''' Remove delivered message from spool. If that fails it must not be sent again, so mark it as sent instead. '''
+    path = os.path.join(spool_dirs['new'], name)
+    try:
+        os.remove(path)
+        return
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        logging.error(f'Could not remove sent spool file "{name}", renaming it to "{name}.sent": {e}')
+    try:
+        # scans only pick up .json files
+        os.replace(path, f'{path}.sent')
+    except OSError as e:
+        logging.critical(f'Could not rename sent spool file "{name}" either, skipping it until the daemon restarts: {e}')
+        deferred[name] = float('inf')
+
+
+def run_daemon(args):
+    ''' Deliver queued messages from spool directory, encrypting them concurrently and sending over one reused SMTP connection '''
+    spool_dirs = get_spool_dirs(args)
+    gpg = get_gpg(args)
+    deferred = {}
+    conn = None
+    last_used = 0
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    logging.info(f'Watching spool directory "{args.spool_dir}"...')
+
+    def encrypt(spool_file):
+        name, entry = spool_file
+        return get_email_string(args.from_address, entry['to'], entry['subject'], entry['message'], gpg, args)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        try:
+            while not stop.is_set():
+                due = get_due_spool_files(spool_dirs, deferred, args.workers * 4)
+                if not due:
+                    if conn is not None and time.monotonic() - last_used > args.smtp_idle_timeout:
+                        close_smtp_connection(conn)
+                        conn = None
+                    stop.wait(args.poll_interval)
+                    continue
+                for (name, entry), enc_msg in zip(due, executor.map(encrypt, due)):
+                    if enc_msg is None:
+                        defer_spool_file(spool_dirs, deferred, name, entry, 'encryption failed', args)
+                        continue
+                    try:
+                        if conn is None:
+                            conn = get_smtp_connection(args)
+                        logging.info(f'Sending email from "{args.from_address}" to "{entry["to"]}"')
+                        conn.sendmail(args.from_address, entry['to'], enc_msg)
+                        last_used = time.monotonic()
+                    except smtplib.SMTPRecipientsRefused as e:
+                        # retrying won't help
+                        entry['attempts'] = args.max_attempts - 1
+                        defer_spool_file(spool_dirs, deferred, name, entry, str(e), args)
+                        continue
+                    except (smtplib.SMTPException, OSError) as e:
+                        if conn is not None:
+                            conn.close()
+                            conn = None
+                        defer_spool_file(spool_dirs, deferred, name, entry, str(e), args)
+                        continue
+                    remove_sent_spool_file(spool_dirs, deferred, name)
+        except KeyboardInterrupt:
+            pass
+    logging.info('Stopping daemon...')
+    if conn is not None:
+        close_smtp_connection(conn)
 
 
 def main():
     args = setup_parser()
     setup_logging(args)
-    send_mail(args)
+    if args.enqueue:
+        enqueue_mail(args)
+    elif args.daemon:
+        run_daemon(args)
+    elif args.batch:
+        send_batch(args)
+    else:
+        send_mail(args)
 
 
 if __name__ == '__main__':
@@ -3,8 +3,15 @@
 # Simple tool to modify audio file tags using mutagen -> https://github.com/quodlibet/mutagen
 
 import argparse
+import ctypes
+import ctypes.util
+import json
 import os
 import re
+import select
+import signal
+import struct
+import time
 
 import mutagen
 
@@ -14,6 +21,16 @@ from azure.ai.inference.models import SystemMessage, UserMessage
 from azure.core.credentials import AzureKeyCredential
 
 
+# file types set_tags can handle
+AUDIO_FILE_EXTENSIONS = ('.flac', '.mp3', '.opus', '.ogg')
+# from linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+# the record of processed files is written after this many changes, at the end of each batch and on exit
+SAVE_PROCESSED_FILES_EVERY = 25
+
 def setup_parser():
     parser = argparse.ArgumentParser()
 
@@ -40,6 +57,12 @@ def setup_parser():
     tracknumber_group.add_argument('-tn', '--tracknumber', help="Track number")
     tracknumber_group.add_argument('-tnai', '--tracknumber-with-ai', action='store_true', help="Set track number from file name using AI to figure out what the track number is", default=False)
 
+    parser.add_argument('-w', '--watch', action='store_true', help="After tagging the files in path, keep watching it and tag new or modified audio files (inotify, polling elsewhere)", default=False)
+    parser.add_argument('-db', '--debounce', type=float, help="Seconds a file must stay unchanged before it gets tagged in watch mode", default=2.0)
+    parser.add_argument('-pi', '--poll-interval', type=float, help="Seconds between directory scans in watch mode without inotify", default=5.0)
+    parser.add_argument('-np', '--no-polling-fallback', action='store_true', help="Exit instead of polling if inotify is not available", default=False)
+    parser.add_argument('-sf', '--state-file', help="Record of processed files (name, size, mtime) in path, untouched files in it are skipped. Used by default in watch mode: .tag_dat_processed.json")
+
     parser.add_argument('-dr', '--dry-run', action='store_true', help="Don't save changes to file(s), activates verbose logging", default=False)
     parser.add_argument('-de', '--debug', action='store_true', help="Debug output", default=False)
     parser.add_argument('-v', '--verbose', action='store_true', help="Verbose logging, defaults to True if debug is True", default=False)
@@ -49,6 +72,11 @@ def setup_parser():
     if not args.file and not args.path:
         args.path = '.'
 
+    if args.watch and not args.path:
+        parser.error('--watch needs a path to watch')
+    if args.watch and not args.state_file:
+        args.state_file = '.tag_dat_processed.json'
+
     if args.debug or args.dry_run:
         args.verbose = True
 
@@ -276,8 +304,153 @@ def set_tags(args, file, ai_client, user_modified_ai_responses=[]):
     return user_modified_ai_responses
 
 
+def is_audio_file(filename):
+    # yt-dlp and ffmpeg write to .part and .temp.* files first and rename them when done
+    return filename.lower().endswith(AUDIO_FILE_EXTENSIONS) and '.temp.' not in filename and not filename.startswith('.')
+
+
+def get_file_state(file):
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
+        return None
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def load_processed_files(state_file):
+    try:
+        with open(state_file, 'r', encoding='UTF-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        print(f'E: Record of processed files "{state_file}" is corrupt, starting a new one')
+        return {}
+
+
+def save_processed_files(state_file, processed_files):
+    with open(f'{state_file}.tmp', 'w', encoding='UTF-8') as f:
+        json.dump(processed_files, f)
+    os.replace(f'{state_file}.tmp', state_file)
+
+
+def tag_files(args, files, ai_client, user_modified_ai_responses, processed_files):
+    # tag files through set_tags, skipping files whose size and mtime match the record of processed files
+    unsaved = 0
+    for file in files:
+        if processed_files is not None:
+            state = get_file_state(file)
+            if state is None:
+                if processed_files.pop(file, None) is not None:
+                    unsaved += 1
+                continue
+            if processed_files.get(file) == state:
+                if args.debug:
+                    print(f'Skipping unchanged file {file}')
+                continue
+        user_modified_ai_responses = set_tags(args, file, ai_client, user_modified_ai_responses)
+        if processed_files is not None and not args.dry_run:
+            # state after saving, so the close-write event of our own save doesn't trigger another run
+            state = get_file_state(file)
+            if state is not None:
+                processed_files[file] = state
+                unsaved += 1
+            if unsaved >= SAVE_PROCESSED_FILES_EVERY:
+                save_processed_files(args.state_file, processed_files)
+                unsaved = 0
+    if unsaved and not args.dry_run:
+        save_processed_files(args.state_file, processed_files)
+    return user_modified_ai_responses
+
+
+def get_inotify_fd(path):
+    # inotify through libc, returns None where it isn't available
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return None
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        print(f'E: inotify_init1 failed: {os.strerror(ctypes.get_errno())}')
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE) < 0:
+        print(f'E: inotify_add_watch failed: {os.strerror(ctypes.get_errno())}')
+        os.close(fd)
+        return None
+    return fd
+
+
+def read_inotify_events(fd, timeout):
+    # names of files with events within timeout seconds
+    readable, _, _ = select.select([fd], [], [], timeout)
+    if not readable:
+        return []
+    buffer = os.read(fd, 64 * 1024)
+    names = []
+    offset = 0
+    while offset < len(buffer):
+        name_length = INOTIFY_EVENT_HEADER.unpack_from(buffer, offset)[3]
+        offset += INOTIFY_EVENT_HEADER.size
+        names.append(os.fsdecode(buffer[offset:offset + name_length].rstrip(b'\0')))
+        offset += name_length
+    return names
+
+
+def scan_directory(last_states):
+    # names of audio files in the current directory whose size or mtime changed since the last scan
+    changed = []
+    for entry in os.scandir('.'):
+        if entry.is_file() and is_audio_file(entry.name):
+            state = get_file_state(entry.name)
+            if state is not None and last_states.get(entry.name) != state:
+                last_states[entry.name] = state
+                changed.append(entry.name)
+    return changed
+
+
+def watch(args, ai_client, user_modified_ai_responses, processed_files):
+    fd = get_inotify_fd('.')
+    if fd is None:
+        if args.no_polling_fallback:
+            print('E: inotify is not available and polling fallback is disabled.')
+            exit(1)
+        print(f'inotify is not available, scanning "{args.path}" every {args.poll_interval} seconds')
+        last_states = {}
+        scan_directory(last_states)
+    else:
+        print(f'Watching "{args.path}" for new or modified audio files using inotify')
+    # name -> time of the last event, files are tagged once no new event came in for the debounce time
+    pending = {}
+    while True:
+        now = time.monotonic()
+        due = [file for file, last_event in pending.items() if now - last_event >= args.debounce]
+        for file in due:
+            del pending[file]
+        if due:
+            user_modified_ai_responses = tag_files(args, sorted(due), ai_client, user_modified_ai_responses, processed_files)
+
+        timeout = min([args.debounce - (now - last_event) for last_event in pending.values()] + [args.poll_interval])
+        if fd is None:
+            time.sleep(max(timeout, 0))
+            names = scan_directory(last_states)
+        else:
+            names = read_inotify_events(fd, max(timeout, 0))
+        for name in names:
+            if is_audio_file(name):
+                pending[name] = time.monotonic()
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
 def main():
     args = setup_parser()
+    # stopping the watch mode via SIGTERM, e.g. by systemd, takes the same path as Ctrl+C
+    signal.signal(signal.SIGTERM, interrupt)
+    processed_files = None
     try:
         user_modified_ai_responses = []
         ai_client = None
@@ -293,11 +466,21 @@ def main():
         if args.path:
             os.chdir(args.path)
             files = [f for f in os.listdir('.')]
-            for file in files:
-                user_modified_ai_responses = set_tags(args, file, ai_client, user_modified_ai_responses)
+            if args.state_file:
+                processed_files = load_processed_files(args.state_file)
+                user_modified_ai_responses = tag_files(args, [f for f in files if is_audio_file(f)], ai_client, user_modified_ai_responses, processed_files)
+            else:
+                for file in files:
+                    user_modified_ai_responses = set_tags(args, file, ai_client, user_modified_ai_responses)
+            if args.watch:
+                watch(args, ai_client, user_modified_ai_responses, processed_files)
     except KeyboardInterrupt:
         print("\nInterrupted by user. Exiting...")
         exit(1)
+    finally:
+        # files tagged since the last save would be tagged again on the next run otherwise
+        if processed_files is not None and not args.dry_run:
+            save_processed_files(args.state_file, processed_files)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import logging
+import os
 import re
 import requests
+import sys
+import threading
+
+from datetime import datetime, timedelta, timezone
+
+# shared HTTP client from ../api_client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'api_client'))
+import api_client
 
 
 log_levels = {'crit': logging.CRITICAL, 'warn': logging.WARN, 'info': logging.INFO, 'debug': logging.DEBUG}
+# Trello allows 100 requests per 10 seconds per token
+rate_limit_window = 10
+# maximum number of cards Trello returns per request
+max_cards_per_page = 1000
 
 
 def setup_parser():
@@ -18,6 +32,14 @@ def setup_parser():
     parser.add_argument('-v', '--log-level', help=f'Log level, possible choices: {list(log_levels)}', default='info')
     parser.add_argument('-l', '--log-file', help='Log file', default='trello_archive_cleanup.log')
     parser.add_argument('-f', '--no-dry-run', help='Actually delete cards.', action='store_true')
+    parser.add_argument('-a', '--min-age-days', help='Only delete cards without activity for at least n days', type=float)
+    parser.add_argument('-pp', '--per-page', help=f'Cards per listing request, maximum {max_cards_per_page}', type=int, default=max_cards_per_page)
+    parser.add_argument('-w', '--workers', help='Number of concurrent requests', type=int, default=8)
+    parser.add_argument('-rl', '--rate-limit', help=f'Maximum requests per {rate_limit_window} seconds', type=int, default=90)
+    parser.add_argument('-r', '--retries', help='Retries per request on 429 or server errors', type=int, default=5)
+    parser.add_argument('-j', '--journal', help='Journal file recording listed cards and deletions when not in dry run mode', default='trello_archive_cleanup_journal.jsonl')
+    parser.add_argument('-re', '--resume', help='Resume interrupted run from journal instead of starting over', action='store_true')
+    api_client.add_arguments(parser)
     args = parser.parse_args()
     return args
 
@@ -35,76 +57,245 @@ def setup_base_headers():
     global base_headers
     base_headers = {'Accept': 'application/json'}
 
+def setup_client(args):
+    ''' Setup shared keep-alive client with rate limiter for all requests '''
+    global client
+    # key and token go in the Authorization header, as query parameters they would end up in every logged URL and error
+    headers = dict(base_headers, Authorization=f'OAuth oauth_consumer_key="{args.api_key}", oauth_token="{args.api_token}"')
+    client = api_client.ApiClient('https://api.trello.com/1', headers=headers,
+                                  timeout=args.timeout, connect_timeout=args.connect_timeout, retries=args.retries, pool_size=args.workers,
+                                  rate_limiter=api_client.RateLimiter(args.rate_limit, rate_limit_window))
+
+def request(method, path, args, params=None):
+    ''' Make rate limited request to Trello API, retrying on 429 (honoring Retry-After) and server errors '''
+    return client.request(method, path, params)
+
+
+class Journal:
+    ''' Append-only JSON lines journal of listed boards and cards and the outcome of their deletion '''
+    def __init__(self, path, resume):
+        self.boards = None
+        self.boards_done = set()
+        # per board: pending (listed but not yet deleted) cards, listing cursor and whether listing finished
+        self.board_states = {}
+        self.lock = threading.Lock()
+        if resume:
+            self.load(path)
+        self.file = open(path, 'a' if resume else 'w', encoding='UTF-8')
+
+    def get_board_state(self, board_id):
+        return self.board_states.setdefault(board_id, {'pending': {}, 'before': None, 'listed': False})
+
+    def load(self, path):
+        try:
+            with open(path, 'r', encoding='UTF-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line might be incomplete if the previous run was killed while writing
+                        logging.warning(f"Ignoring corrupt journal line: {line!r}")
+                        continue
+                    self.apply(entry)
+        except FileNotFoundError:
+            logging.warning(f"No journal found at '{path}', starting from scratch.")
+            return
+        logging.info(f"Loaded journal '{path}': {len(self.boards_done)} boards done, {sum(len(state['pending']) for state in self.board_states.values())} cards pending.")
+
+    def apply(self, entry):
+        if entry['event'] == 'boards':
+            self.boards = entry['boards']
+        elif entry['event'] == 'page':
+            board_state = self.get_board_state(entry['board'])
+            board_state['pending'].update(entry['cards'])
+            board_state['before'] = entry['before']
+            board_state['listed'] = entry['before'] is None
+        elif entry['event'] == 'deleted':
+            self.get_board_state(entry['board'])['pending'].pop(entry['card'], None)
+        elif entry['event'] == 'board_done':
+            self.boards_done.add(entry['board'])
+
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def record_boards(self, boards):
+        self.write({'event': 'boards', 'boards': boards})
+
+    def record_page(self, board_id, cards, before):
+        ''' Record listed cards of a page and the cursor of the next page, None if listing is done '''
+        self.write({'event': 'page', 'board': board_id, 'cards': {card['id']: card['name'] for card in cards}, 'before': before})
+
+    def record_deletion(self, board_id, card_id, status_code):
+        self.write({'event': 'deleted' if status_code in (200, 404) else 'failed', 'board': board_id, 'card': card_id, 'status': status_code})
+
+    def record_board_done(self, board_id):
+        self.write({'event': 'board_done', 'board': board_id})
+
+    def close(self):
+        self.file.close()
+
+def open_journal(args):
+    ''' Open journal, it is only used when actually deleting cards '''
+    if not args.no_dry_run:
+        if args.resume:
+            logging.warning('Journal is not used in dry run mode, ignoring --resume.')
+        return None
+    return Journal(args.journal, args.resume)
+
 def get_boards(args):
     ''' Get all boards IDs and names '''
     boards = []
-    api_boards = requests.get(f"https://api.trello.com/1/members/me/boards?fields=name&key={args.api_key}&token={args.api_token}", headers=base_headers)
+    api_boards = request('GET', 'members/me/boards', args, {'fields': 'name,memberships'}).json()
     member_id = get_member_id(args)
-    for board in api_boards.json():
-        if can_delete_cards_on_board(board, member_id, args):
+    # boards normally come with their memberships, only fall back to one membership request per board if they don't
+    missing_memberships = [board for board in api_boards if 'memberships' not in board]
+    with api_client.BoundedExecutor(args.workers) as executor:
+        for board, memberships in zip(missing_memberships, executor.map(lambda board: get_board_memberships(board, args), missing_memberships)):
+            board['memberships'] = memberships
+    for board in api_boards:
+        if can_delete_cards_on_board(board, member_id):
             boards.append({'id': board['id'], 'name': board['name']})
     return boards
 
 def get_board_name(args):
     ''' Get board name by given board ID '''
-    board_name = requests.get(f"https://api.trello.com/1/boards/{args.board_id}/name?key={args.api_key}&token={args.api_token}", headers=base_headers)
+    board_name = request('GET', f"boards/{args.board_id}/name", args)
     board_name = board_name.json()['_value']
     logging.info(f"Found name '{board_name}' for board with ID '{args.board_id}'")
     return board_name
 
-def can_delete_cards_on_board(board, member_id, args):
+def get_board_memberships(board, args):
+    ''' Get memberships of board with given ID '''
+    return request('GET', f"boards/{board['id']}/memberships", args).json()
+
+def can_delete_cards_on_board(board, member_id):
     ''' Check whether our user has the right membership on found boards to actually delete cards '''
     logging.debug(f"Starting membership evaluation for board with ID '{board['id']}' and name '{board['name']}'...")
-    board_memberships = requests.get(f"https://api.trello.com/1/boards/{board['id']}/memberships?key={args.api_key}&token={args.api_token}", headers=base_headers)
-    for board_membership in board_memberships.json():
+    for board_membership in board['memberships']:
         if board_membership['idMember'] == member_id and board_membership['memberType'] == 'admin':
             logging.debug(f"User with member ID '{board_membership['idMember']}' can delete cards on board with ID '{board['id']}' and name '{board['name']}'.")
             return True
-    logging.warning(f"User with member ID '{board_membership['idMember']}' can't delete cards on board with ID '{board['id']}' and name '{board['name']}'.")
+    logging.warning(f"User with member ID '{member_id}' can't delete cards on board with ID '{board['id']}' and name '{board['name']}'.")
     return False
 
 def get_member_id(args):
     ''' Get ID of user to whom API key and API token belong to '''
-    member = requests.get(f"https://api.trello.com/1/members/me?key={args.api_key}&token={args.api_token}", headers=base_headers)
+    member = request('GET', 'members/me', args, {'fields': 'id'})
     member_id = member.json()['id']
     return member_id
 
-def get_cards(board_id, args):
-    ''' Get closed/archived cards on board with given ID '''
-    cards = []
-    api_cards = requests.get(f"https://api.trello.com/1/boards/{board_id}/cards/closed?key={args.api_key}&token={args.api_token}", headers=base_headers)
-    for card in api_cards.json():
-        cards.append({'id': card['id'], 'name': card['name']})
-    return cards
+def get_cards(board_id, args, journal=None, before=None):
+    ''' Yield closed/archived cards on board with given ID page by page, optionally only those older than --min-age-days '''
+    if args.min_age_days is not None:
+        last_activity_before = datetime.now(timezone.utc) - timedelta(days=args.min_age_days)
+    params = {'fields': 'id,name,dateLastActivity', 'limit': min(args.per_page, max_cards_per_page)}
+    if before:
+        params['before'] = before
+    while True:
+        api_cards = request('GET', f"boards/{board_id}/cards/closed", args, params).json()
+        cards = []
+        for card in api_cards:
+            if args.min_age_days is not None and datetime.fromisoformat(card['dateLastActivity'].replace('Z', '+00:00')) > last_activity_before:
+                logging.debug(f"\tSkipping card with ID '{card['id']}' and name '{card['name']}', last activity at {card['dateLastActivity']}.")
+                continue
+            cards.append({'id': card['id'], 'name': card['name']})
+        # card IDs start with their creation timestamp, so the smallest ID is the cursor for the next (older) page
+        before = min(card['id'] for card in api_cards) if len(api_cards) >= params['limit'] else None
+        if journal:
+            journal.record_page(board_id, cards, before)
+        yield from cards
+        if not before:
+            return
+        params['before'] = before
+
+def get_cards_to_delete(board_id, args, journal):
+    ''' Yield cards pending from journal first, then continue listing where the journal left off '''
+    board_state = journal.board_states.get(board_id) if journal else None
+    if not board_state:
+        yield from get_cards(board_id, args, journal)
+        return
+    logging.info(f"Resuming board with ID '{board_id}' with {len(board_state['pending'])} cards pending from journal...")
+    for card_id, card_name in list(board_state['pending'].items()):
+        yield {'id': card_id, 'name': card_name}
+    if not board_state['listed']:
+        yield from get_cards(board_id, args, journal, board_state['before'])
 
 def delete_card(card_id, args):
-    ''' Delete a card by given ID '''
-    requests.delete(f"https://api.trello.com/1/cards/{card_id}?key={args.api_key}&token={args.api_token}", headers=base_headers)
+    ''' Delete a card by given ID, returns status code. 404 means the card is gone already. '''
+    response = request('DELETE', f"cards/{card_id}", args)
+    return response.status_code
+
+def delete_cards(cards, board_id, args, journal=None):
+    ''' Delete cards through a bounded worker pool, returns number of failed deletions '''
+    failed_count = 0
+    lock = threading.Lock()
+
+    def on_done(future, card):
+        nonlocal failed_count
+        try:
+            status_code = future.result()
+        except requests.RequestException as e:
+            logging.error(f"\tRequest to delete card with ID '{card['id']}' failed: {api_client.redact(e)}")
+            status_code = None
+        if journal:
+            journal.record_deletion(board_id, card['id'], status_code)
+        if status_code == 404:
+            logging.debug(f"\tCard with ID '{card['id']}' and name '{card['name']}' was deleted already.")
+        elif status_code != 200:
+            with lock:
+                failed_count += 1
+            logging.error(f"\tFailed to delete card with ID '{card['id']}' and name '{card['name']}'.")
+
+    # bounds the number of queued deletions, so card pages are only fetched as fast as we delete
+    with api_client.BoundedExecutor(args.workers) as executor:
+        for card in cards:
+            logging.info(f"\tDeleting card with ID '{card['id']}' and name '{card['name']}'...")
+            if args.no_dry_run:
+                executor.submit(delete_card, card['id'], args, callback=lambda future, card=card: on_done(future, card))
+    return failed_count
 
 def main():
     args = setup_parser()
     setup_logging(args)
     setup_base_headers()
-    # Get Trello boards
-    if args.board_id:
-        logging.info(f"Board ID was given. Only processing board with ID '{args.board_id}'.")
-        board_name = get_board_name(args)
-        boards = [{'id': args.board_id, 'name': board_name}]
-    else:
-        boards = get_boards(args)
-    for board in boards:
-        # Get and delete archived cards in boards
-        logging.info(f"Getting archived cards from board with ID '{board['id']}' and name '{board['name']}'...")
-        cards = get_cards(board['id'], args)
-        logging.info(f"Starting to delete cards from board with ID '{board['id']}' and name '{board['name']}'...")
-        for card in cards:
-            logging.info(f"\tDeleting card with ID '{card['id']}' and name '{card['name']}'...")
-            if args.no_dry_run:
-                delete_card(card['id'], args)
-        logging.info(f"Done for board with ID '{board['id']}' and name '{board['name']}'.")
-        logging.info('')
-    if not args.no_dry_run:
-        logging.info('DRY RUN! Nothing was actually deleted.')
+    setup_client(args)
+    try:
+        journal = open_journal(args)
+        # Get Trello boards
+        if args.board_id:
+            logging.info(f"Board ID was given. Only processing board with ID '{args.board_id}'.")
+            board_name = get_board_name(args)
+            boards = [{'id': args.board_id, 'name': board_name}]
+        elif journal and journal.boards is not None:
+            logging.info(f"Using {len(journal.boards)} boards from journal.")
+            boards = journal.boards
+        else:
+            boards = get_boards(args)
+            if journal:
+                journal.record_boards(boards)
+        for board in boards:
+            if journal and board['id'] in journal.boards_done:
+                logging.info(f"Board with ID '{board['id']}' and name '{board['name']}' is done according to journal, skipping.")
+                continue
+            # Get and delete archived cards in boards
+            logging.info(f"Getting archived cards page by page from board with ID '{board['id']}' and name '{board['name']}'...")
+            cards = get_cards_to_delete(board['id'], args, journal)
+            logging.info(f"Starting to delete cards from board with ID '{board['id']}' and name '{board['name']}'...")
+            failed_count = delete_cards(cards, board['id'], args, journal)
+            if failed_count:
+                logging.error(f"Failed to delete {failed_count} cards from board with ID '{board['id']}' and name '{board['name']}'. Run again with --resume to retry.")
+            elif journal:
+                journal.record_board_done(board['id'])
+            logging.info(f"Done for board with ID '{board['id']}' and name '{board['name']}'.")
+            logging.info('')
+        if journal:
+            journal.close()
+        if not args.no_dry_run:
+            logging.info('DRY RUN! Nothing was actually deleted.')
+    finally:
+        client.report(args, 'trello_archive_cleanup')
 
 
 if __name__ == '__main__':
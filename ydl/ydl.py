@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import os
 import re
 import sys
+import time
 # import youtube_dl
 # using yt_dlp instead of youtube_dl because they
 # refuse to make new releases despite active development
 # see https://github.com/ytdl-org/youtube-dl/issues/31585
 import yt_dlp as youtube_dl
+from yt_dlp.postprocessor.metadataparser import MetadataParserPP
 
 
 BASE_OUTPUT_TEMPLATE = '%(title)s.%(ext)s'
@@ -19,13 +22,87 @@ def setup_parser():
     parser.add_argument('-d', '--output-dir', help='Directory to put downloaded files into')
     parser.add_argument('-v', '--verbose', help='Get verbose output', action='store_true')
     parser.add_argument('-c', '--cleanup-download-archives', help='Cleanup download archive files after complete playlist download', action='store_true')
+    parser.add_argument('-i', '--incremental', help='Only fully extract and download playlist entries that are not in the local playlist cache yet', action='store_true')
+    parser.add_argument('-ct', '--cache-ttl', help='Hours after which the playlist cache is rebuilt with a full run in incremental mode', type=float, default=168)
+    parser.add_argument('-nt', '--no-tags', help="Don't write title, artist, album and track number tags into downloaded files", action='store_true')
     args = parser.parse_args()
     return args
 
+def get_tag_postprocessors():
+    ''' Postprocessors writing tags from the info dict, so files don't need tagging with tag_dat afterwards '''
+    return [
+        {
+            # map playlist fields to the ones FFmpegMetadata writes as album and track number tags. The empty defaults
+            # don't match, so videos outside of playlists get no album and track number instead of "NA".
+            'key': 'MetadataParser',
+            'when': 'pre_process',
+            'actions': [
+                (MetadataParserPP.Actions.INTERPRET, '%(playlist_title|)s', '%(album)s'),
+                (MetadataParserPP.Actions.INTERPRET, '%(playlist_index|)s', '%(track_number)s'),
+            ],
+        },
+        {
+            # runs after FFmpegExtractAudio and writes title (track or title), artist (artist, creator or uploader), album and track number
+            'key': 'FFmpegMetadata',
+            'add_metadata': True,
+        },
+    ]
+
 def run_ydl(ydl_opts, url):
     with youtube_dl.YoutubeDL(ydl_opts) as ydl:
         ydl.download([url])
 
+def get_playlist_entries(url, verbose):
+    ''' Get IDs, indexes and titles of playlist entries with flat extraction, which only lists the playlist '''
+    with youtube_dl.YoutubeDL({'extract_flat': 'in_playlist', 'quiet': not verbose}) as ydl:
+        info = ydl.extract_info(url, download=False)
+    entries = []
+    for index, entry in enumerate(info.get('entries') or [], start=1):
+        # unavailable videos show up as None
+        if entry:
+            entries.append({'id': entry['id'], 'index': index, 'title': entry.get('title')})
+    return info.get('title'), entries
+
+def load_playlist_cache(cache_file, ttl_hours):
+    try:
+        with open(cache_file, 'r', encoding='UTF-8') as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        print(f"No playlist cache at '{cache_file}' yet...")
+        return None
+    except ValueError:
+        print(f"Playlist cache at '{cache_file}' is corrupt, ignoring it...")
+        return None
+    if time.time() - cache['fetched_at'] > ttl_hours * 3600:
+        print(f"Playlist cache at '{cache_file}' is older than {ttl_hours} hours, doing a full run...")
+        return None
+    return cache
+
+def save_playlist_cache(cache_file, title, entries, fetched_at):
+    with open(f'{cache_file}.tmp', 'w', encoding='UTF-8') as f:
+        json.dump({'fetched_at': fetched_at, 'title': title, 'entries': entries}, f)
+    os.replace(f'{cache_file}.tmp', cache_file)
+
+def run_ydl_incremental(ydl_opts, url, cache_file, args):
+    ''' Diff flat playlist listing against cache and only run full extraction and download for new entries '''
+    cache = load_playlist_cache(cache_file, args.cache_ttl)
+    title, entries = get_playlist_entries(url, args.verbose)
+    if cache is None:
+        # full run, download archive skips what was downloaded before
+        fetched_at = time.time()
+        run_ydl(ydl_opts, url)
+    else:
+        fetched_at = cache['fetched_at']
+        known_ids = {entry['id'] for entry in cache['entries']}
+        new_entries = [entry for entry in entries if entry['id'] not in known_ids]
+        if not new_entries:
+            print(f"No new entries in playlist '{title}'.")
+        else:
+            print(f"Found {len(new_entries)} new entries in playlist '{title}': {[entry['title'] for entry in new_entries]}")
+            # select by index instead of downloading video URLs, so playlist fields for file names and tags stay available
+            run_ydl(dict(ydl_opts, playlist_items=','.join(str(entry['index']) for entry in new_entries)), url)
+    save_playlist_cache(cache_file, title, entries, fetched_at)
+
 def main():
     args = setup_parser()
     if args.url:
@@ -42,6 +119,8 @@ def main():
                 'preferredcodec': 'opus'
             }]
         }
+        if not args.no_tags:
+            ydl_opts['postprocessors'] += get_tag_postprocessors()
         if args.verbose:
             ydl_opts['verbose'] = 'true'
         output_template = ""
@@ -54,12 +133,19 @@ def main():
             output_template += '%(playlist_index)s_'
             playlist_id = re.sub(r'.*list=', '', args.url)
             DOWNLOAD_ARCHIVE_FILE = f'/tmp/ydl_archive_{playlist_id}.txt'
+            PLAYLIST_CACHE_FILE = f'/tmp/ydl_playlist_cache_{playlist_id}.json'
             ydl_opts['download_archive'] = DOWNLOAD_ARCHIVE_FILE
         else:
             print("Is an individual YouTube video...")
+            if args.incremental:
+                print("Incremental mode only works for playlists, ignoring it...")
+                args.incremental = False
         output_template += BASE_OUTPUT_TEMPLATE
         ydl_opts.update({'outtmpl': output_template})
-        run_ydl(ydl_opts, args.url)
+        if args.incremental:
+            run_ydl_incremental(ydl_opts, args.url, PLAYLIST_CACHE_FILE, args)
+        else:
+            run_ydl(ydl_opts, args.url)
         if args.cleanup_download_archives and os.path.exists(DOWNLOAD_ARCHIVE_FILE):
             print(f"Removing download archive at '{DOWNLOAD_ARCHIVE_FILE}'...")
             os.remove(DOWNLOAD_ARCHIVE_FILE)